@@ -0,0 +1,90 @@
+import nomads_server
+import argparse
+import subprocess
+import tempfile
+import shutil
+import glob
+import time
+import sys
+import os
+import re
+
+"""
+Benchmark downloader.py against the local NOMADS stand-in (nomads_server.py),
+e.g. to compare different concurrency settings or retry strategies offline.
+The server runs in a thread of this process while the downloader is started
+as a subprocess, exactly as done in get_grib.run, once for every number of
+workers. The throttling of the server can be tuned with the same options
+of nomads_server.py, e.g.
+    python bench_downloader.py --workers 1 4 8 16 --max-connections 6 --latency 0.1
+"""
+
+parser = argparse.ArgumentParser(parents=[nomads_server.parser], conflict_handler='resolve')
+
+parser.add_argument('--port', help='Port to listen to (0 = any free port)', default=0, type=int)
+parser.add_argument('-w', '--workers', help='Maximum concurrent downloads to compare',
+                    default=[2, 4, 8], type=int, nargs='+')
+parser.add_argument('-f', '--fcst', help='Forecast hours to download',
+                    default=[f"f{r:03d}" for r in range(3, 123, 3)], nargs='+')
+parser.add_argument('-n', '--repeat', help='Repetitions for every setting',
+                    default=1, type=int)
+
+# Same variables downloaded by get_grib.run
+variables = ["PRMSL", "SNOD", "CRAIN", "CSNOW", "PRATE", "APCP"] + \
+    [var for var in ["TMP", "HGT", "UGRD", "VGRD"] for i in range(7)] + ["TCDC", "HGT"]
+levels = ["mean sea level"] + ["surface"] * 5 + \
+    ["10 mb", "50 mb", "150 mb", "250 mb", "300 mb", "500 mb", "850 mb"] * 4 + \
+    ["entire atmosphere", "0C isotherm"]
+
+downloader = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'downloader.py')
+
+
+def main():
+    args = parser.parse_args()
+    server = nomads_server.start(args)
+    url = f'http://{args.host}:{server.server_address[1]}/'
+
+    results = []
+    for workers in args.workers:
+        for i in range(args.repeat):
+            results.append(run(server, url, workers, args.fcst))
+            print_result(results[-1])
+
+    server.shutdown()
+
+
+def run(server, url, workers, fcst):
+    """Download all forecast hours with the given maximum number of workers
+    and collect the counters of both the downloader and the server."""
+    folder = tempfile.mkdtemp(prefix='bench_downloader_')
+    server.reset_stats()
+    start = time.time()
+    out = subprocess.run([sys.executable, downloader, '-d', '20220826', '-r', '06',
+                          '-o', folder, '-u', url, '-w', str(workers),
+                          '-f', *fcst, '-v', *variables, '-l', *levels],
+                         capture_output=True, text=True)
+    wall = time.time() - start
+    files = [f for f in glob.glob(f'{folder}/grib_gfs_*_f???') if os.path.getsize(f) > 0]
+    size = sum(os.path.getsize(f) for f in files)
+    shutil.rmtree(folder)
+    if out.returncode != 0:
+        print(out.stderr[-2000:])
+    match = re.search(r'(\d+) retries, (\d+) throttled', out.stdout)
+    retries, throttled = (int(match.group(1)), int(match.group(2))) if match else (-1, -1)
+
+    return dict(workers=workers, wall=wall, files=len(files), expected=len(fcst),
+                size=size, retries=retries, throttled=throttled, **server.stats)
+
+
+def print_result(r):
+    print(f"workers={r['workers']:3d} wall={r['wall']:7.2f} s "
+          f"files={r['files']}/{r['expected']} "
+          f"requests={r['requests']} ({r['requests'] / r['wall']:.1f}/s) "
+          f"sent={r['bytes'] / 1024. ** 2:.1f} MB ({r['bytes'] / 1024. ** 2 / r['wall']:.2f} MB/s) "
+          f"written={r['size'] / 1024. ** 2:.1f} MB "
+          f"retries={r['retries']} throttled={r['throttled']} "
+          f"(403={r['forbidden']}, empty={r['empty']}, dropped={r['dropped']})", flush=True)
+
+
+if __name__ == "__main__":
+    main()
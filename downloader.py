@@ -1,16 +1,30 @@
-import pandas as pd
+import inventory
 import requests
 import argparse
-from tqdm.contrib.concurrent import process_map
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import shutil
 import time
+import json
+import os
 import random
+import re
 
 """
 Script to download files from the NOMADS server.
-Note that the number of workers and sleep commands are optimized
-to nothit the throttling limit of the server. Unfortunately you 
-cannot make the download process faster because you're going to 
-hit this limit eventually.
+The server throttles clients that make too many requests (403, 429 or
+empty answers), so instead of sleeping a fixed amount of time the number
+of concurrent requests is adapted with an AIMD policy: it grows slowly
+while the requests succeed and is halved as soon as the server throttles
+us. Connections are kept alive and reused, and interrupted multi-range
+transfers are resumed by requesting only the ranges that are missing.
+Adjacent messages are requested as a single range and the data is
+written to disk while it is received, into a temporary file which is
+renamed only when complete.
+The messages already downloaded are recorded in a manifest, so that when
+the download of a run is started again only the forecast hours and the
+messages that are missing (or changed on the server) are requested.
 """
 
 parser = argparse.ArgumentParser()
@@ -32,77 +46,466 @@ parser.add_argument('-l', '--levs', help='Vertical levels',
 parser.add_argument('-d', '--date', help='Date (e.g. 20220826)', required=True)
 parser.add_argument('-r', '--run', help='Run (e.g. 06)', required=True)
 parser.add_argument('-o', '--folder', help='Output folder', default="./")
+parser.add_argument('-s', '--stream', help='Print the name of every file as soon as it is '
+                    'written, so that it can be piped to the plotting (render_all.py --stream)',
+                    action='store_true')
+parser.add_argument('-w', '--workers', help='Maximum number of concurrent downloads',
+                    default=8, type=int)
+parser.add_argument('-g', '--gap', help='Ranges closer than this (bytes) are requested as '
+                    'a single one', default=0, type=int)
+parser.add_argument('--max-ranges', help='Maximum number of ranges in a request',
+                    default=100, type=int)
+parser.add_argument('--max-request', help='Maximum size of a request (MB)',
+                    default=100, type=float)
+parser.add_argument('--overwrite', help='Download everything again, ignoring the files '
+                    'already downloaded', action='store_true')
+parser.add_argument('-u', '--url', help='Base URL of the server',
+                    default="https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/")
 
 # Get the arguments passed from the command line
 args = parser.parse_args()
 
+# Concurrency used at the beginning, the controller then finds the right one
+initial_workers = 4
+max_retry = 5
+# Seconds to wait before retrying, doubled at every retry
+backoff = 1.
+timeout = (10, 60)
+# Data received is written to disk (and kept if the connection drops) in chunks of
+chunk_size = 64 * 1024
+
+
+class Controller():
+    """Limit the number of concurrent requests with an additive increase,
+    multiplicative decrease (AIMD) policy as done by TCP: the limit grows
+    by one request for every round of successful requests and is halved
+    (at most once per cooldown) when the server throttles us."""
+
+    def __init__(self, limit, max_limit, cooldown=backoff):
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.cooldown = cooldown
+        self.active = 0
+        self.paused_until = 0.
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while (self.active >= int(self.limit)) or (time.time() < self.paused_until):
+                self.condition.wait(timeout=0.1)
+            self.active += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.active -= 1
+            now = time.time()
+            if throttled:
+                if now >= self.paused_until:
+                    self.limit = max(1., self.limit / 2.)
+                # Give the server some time before starting new requests
+                self.paused_until = now + self.cooldown
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1. / self.limit)
+            self.condition.notify_all()
+
+
+class Stats():
+    """Counters shared by all the downloads, used to report the throughput."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.bytes = 0
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def throughput(self):
+        return self.bytes / 1024. ** 2 / max(time.time() - self.start, 1e-3)
+
+    def report(self):
+        return (f"Downloaded {self.bytes / 1024. ** 2:.1f} MB in {time.time() - self.start:.1f} s "
+                f"({self.throughput():.2f} MB/s): {self.requests} requests, "
+                f"{self.retries} retries, {self.throttled} throttled")
+
+
+controller = Controller(min(initial_workers, args.workers), args.workers)
+stats = Stats()
+local = threading.local()
+manifest = None
+selection = None
+
 
 def main():
-    if len(args.vars) != len(args.levs):
-        raise ValueError('Variables and levels should have the same size')
+    global manifest, selection
+    selection = inventory.Selection(args.vars, args.levs)
+    manifest = Manifest(f"{args.folder}/grib_gfs_{args.date}_{args.run}_manifest.json",
+                        overwrite=args.overwrite)
     # Create iterator for download
     it = [{'fcst': i} for i in args.fcst]
     # Launch downloading
-    files = process_map(download, it, chunksize=10, max_workers=4)
+    files = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(download, i) for i in it]
+        progress = tqdm(as_completed(futures), total=len(futures))
+        for future in progress:
+            filename = future.result()
+            if args.stream and filename:
+                print(filename, flush=True)
+            files.append(filename)
+            progress.set_postfix(workers=int(controller.limit),
+                                 MBs=f"{stats.throughput():.2f}")
+    print(stats.report())
 
     return files
 
 
 def download(it):
-    # Randomly sleep for some amount of time to not overload the server
-    time.sleep(random.uniform(0.1, 1.1))
     # Unpack payload
     fcst = it['fcst']
     # Build url
     url = (
-        "https://nomads.ncep.noaa.gov/pub/data/nccf/com/gfs/prod/"
+        f"{args.url}"
         f"gfs.{args.date}/{args.run}"
         "/atmos/"
         f"gfs.t{args.run}z.pgrb2.0p25.{fcst}"
     )
     idx_url = url + ".idx"
-    # This contains the columns needed to get only the variables that we need
-    sel = pd.DataFrame({'var': args.vars, 'level': args.levs})
+    filename = f"{args.folder}/grib_gfs_{args.date}_{args.run}_{fcst}"
+    # Nothing to do if all variables were already downloaded
+    done = manifest.get(fcst, filename)
+    if selection.keys <= {(m['var'], m['level']) for m in done}:
+        return filename
     # Get the inventory file
-    inventory = pd.read_csv(idx_url, sep=":", index_col=0,
-                            names=['byte_begin', 'date', 'var', 'level', 'fcst', 'member'])
-    inventory['byte_end'] = inventory.byte_begin.shift(
-        -1).fillna(0).astype(int)
+    idx = TextTransfer()
+    if not fetch(idx_url, idx):
+        print(f'Could not download {idx_url}')
+        return None
     # And only select the variables that we need
-    selection = inventory.merge(sel, left_on=['var', 'level'], right_on=[
-                                'var', 'level'], how='right')
-    # Only select istantaneous and accumulated values (cause preciptation also has average)
-    selection = selection[selection.fcst.str.contains(r'^\d+ hour fcst|^0-\d+ (?:hour|day) acc fcst')]
-    # Rain accumulated is sometimes duplicated...don't know why, needs to be investigated
-    selection = selection.drop_duplicates(subset=['var','level','fcst'])
-    # Get the corresponding bytes sections in the file
-    byte_selection = "bytes="
-    byte_selection += ",".join(selection["byte_begin"].astype(
-        str) + '-' + selection["byte_end"].astype(str))
-    # Create the request
-    headers = {"Range": byte_selection}
-    # Wait again before launching the next request
-    time.sleep(0.5)
-    r = requests.get(url, headers=headers)
-    # Check if we get some data, as the NOMADS servers are shit
-    max_retry = 5
-    retry = 0
-    while (len(r.content) == 0) and (retry <= max_retry):
-        # backoff just a little bit to make the server happy
-        time.sleep(1)
-        r = requests.get(url, headers=headers)
-        retry += 1
-    if retry == max_retry:
-        print(f'WARNING: reached maximum limit of retries ({max_retry})')
-    if r.status_code == 403:
+    parsed = inventory.parse(idx.text)
+    messages = parsed.messages(selection.select(parsed))
+    # If any message changed on the server the file is downloaded again
+    hashes = {m['hash'] for m in messages}
+    requested = {(m['var'], m['level']) for m in messages}
+    if any(m['hash'] not in hashes for m in done if (m['var'], m['level']) in requested):
+        done = []
+    missing = [m for m in messages if m['hash'] not in {d['hash'] for d in done}]
+    if not missing:
+        return filename
+    # Get the corresponding bytes sections in the file and write them directly
+    # to disk, after the messages already downloaded. A temporary file is used
+    # so that a file with the final name is always complete
+    temp = filename + '.part'
+    if done:
+        shutil.copyfile(filename, temp)
+    with open(temp, "r+b" if done else "wb") as f:
+        transfer = RangesTransfer([(m['begin'], m['end']) for m in missing], f,
+                                  offset=os.path.getsize(temp) if done else 0,
+                                  gap=args.gap, max_ranges=args.max_ranges,
+                                  max_bytes=int(args.max_request * 1024 ** 2))
+        complete = fetch(url, transfer)
+    if not complete:
+        # The file and the manifest still describe what was completely
+        # downloaded, which is where the next run starts from
         print(f'Could not download {url}')
+        os.remove(temp)
         return None
-    # Save the file
-    filename = f"{args.folder}/grib_gfs_{args.date}_{args.run}_{fcst}"
-    open(filename, "wb").write(r.content)
+    os.replace(temp, filename)
+    manifest.update(fcst, filename, done + missing)
 
     return filename
 
 
+class Manifest():
+    """Messages already downloaded for every forecast hour of the run, saved
+    in a JSON file next to the GRIB files. The size of every file is saved
+    too, so that files which were not completely written are not trusted."""
+
+    def __init__(self, filename, overwrite=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.hours = {}
+        if os.path.exists(filename) and not overwrite:
+            try:
+                with open(filename) as f:
+                    self.hours = json.load(f)
+            except ValueError:
+                print(f'WARNING: could not read {filename}, downloading everything again')
+
+    def get(self, fcst, filename):
+        """Messages already in filename, if it is still the one described."""
+        with self.lock:
+            hour = self.hours.get(fcst)
+        if (hour is None) or (not os.path.exists(filename)) or \
+                (os.path.getsize(filename) != hour['size']):
+            return []
+        return hour['messages']
+
+    def update(self, fcst, filename, messages):
+        with self.lock:
+            self.hours[fcst] = {'size': os.path.getsize(filename), 'messages': messages}
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.hours, f, indent=1)
+            os.replace(self.filename + '.tmp', self.filename)
+
+
+def get_session():
+    """Every thread keeps its own session so that the connection to the
+    server (and the TLS handshake) is reused between requests."""
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+    return local.session
+
+
+def fetch(url, transfer):
+    """Download url into transfer, retrying with an exponential backoff
+    until the transfer is complete. Returns False if it never completes or
+    the server answers with an error which is not throttling.
+    A transfer can need many requests, the retries are counted only for
+    the ones that do not receive anything."""
+    retry = 0
+    while not transfer.complete():
+        try:
+            written = attempt(url, transfer)
+        except requests.HTTPError as e:
+            # e.g. forecast hour not published yet or range not satisfiable
+            print(f'WARNING: {e}')
+            return False
+        if written > 0:
+            retry = 0
+            continue
+        retry += 1
+        if retry > max_retry:
+            print(f'WARNING: reached maximum limit of retries ({max_retry}) for {url}')
+            return False
+        stats.add(retries=1)
+        time.sleep(backoff * 2 ** (retry - 1) * random.uniform(0.5, 1.5))
+
+    return True
+
+
+def attempt(url, transfer):
+    """Make a single request, within the concurrency allowed by the controller.
+    Refused requests, empty answers and dropped connections are reported to
+    the controller as throttling. Returns the number of bytes written by the
+    transfer, also when the connection was dropped in the middle."""
+    controller.acquire()
+    throttled = True
+    written = transfer.written
+    try:
+        with get_session().get(url, headers=transfer.headers(), stream=True,
+                               timeout=timeout) as r:
+            stats.add(requests=1)
+            if r.status_code in (403, 429):
+                return 0
+            throttled = False
+            # Any other error (e.g. run not available yet) is not recoverable,
+            # it is raised to fetch
+            r.raise_for_status()
+            transfer.consume(r)
+            throttled = (transfer.written == written)
+    except (requests.ConnectionError, requests.Timeout,
+            requests.exceptions.ChunkedEncodingError):
+        throttled = True
+    finally:
+        written = transfer.written - written
+        stats.add(bytes=written)
+        if throttled:
+            stats.add(throttled=1)
+        controller.release(throttled)
+
+    return written
+
+
+class TextTransfer():
+    """A small text file (e.g. the inventory) downloaded in one go."""
+
+    def __init__(self):
+        self.text = None
+        self.written = 0
+
+    def headers(self):
+        return None
+
+    def consume(self, r):
+        content = r.content
+        if content:
+            self.text = r.text
+            self.written += len(content)
+
+    def complete(self):
+        return bool(self.text)
+
+
+class RangesTransfer():
+    """Byte ranges (begin, end) of a file, written one after the other to the
+    open file f starting at offset, in the same order they have in the file.
+    The end of the last message of a file is not known from the inventory
+    (None) and is requested as an open range. Ranges closer than gap bytes
+    are requested as a single one and every request contains at most
+    max_ranges ranges and max_bytes bytes, so that big selections are split
+    in many requests. The data is written as soon as it is received and
+    the bytes received are counted for every range, so that if the transfer
+    is interrupted only what is missing is requested again."""
+
+    def __init__(self, ranges, f, offset=0, gap=0, max_ranges=100, max_bytes=100 * 1024 ** 2):
+        self.ranges = sorted(ranges, key=lambda r: r[0])
+        self.f = f
+        self.gap = gap
+        self.max_ranges = max_ranges
+        self.max_bytes = max_bytes
+        # Only the last range can be open, so all offsets are known
+        self.offsets = []
+        for begin, end in self.ranges:
+            self.offsets.append(offset)
+            offset += 0 if end is None else end - begin + 1
+        self.received = [0] * len(self.ranges)
+        self.written = 0
+        # Size of the remote file, known only after the first answer
+        self.size = None
+
+    def end(self, i):
+        end = self.ranges[i][1]
+        if end is None and self.size is not None:
+            return self.size - 1
+        return end
+
+    def missing(self):
+        """Ranges (or part of them) that were not received yet."""
+        missing = []
+        for i, (begin, _) in enumerate(self.ranges):
+            end = self.end(i)
+            if end is None or begin + self.received[i] <= end:
+                missing.append((begin + self.received[i], end))
+        return missing
+
+    def requests(self):
+        """Missing ranges, merged and split in requests."""
+        merged = []
+        for begin, end in self.missing():
+            if merged and merged[-1][1] is not None and begin - merged[-1][1] - 1 <= self.gap:
+                merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((begin, end))
+        # Split the ranges that are too big for a single request
+        ranges = []
+        for begin, end in merged:
+            while end is not None and end - begin + 1 > self.max_bytes:
+                ranges.append((begin, begin + self.max_bytes - 1))
+                begin += self.max_bytes
+            ranges.append((begin, end))
+        requests = [[]]
+        size = 0
+        for begin, end in ranges:
+            length = 0 if end is None else end - begin + 1
+            if requests[-1] and (len(requests[-1]) >= self.max_ranges or size + length > self.max_bytes):
+                requests.append([])
+                size = 0
+            requests[-1].append((begin, end))
+            size += length
+
+        return requests
+
+    def headers(self):
+        return {"Range": "bytes=" + ",".join(f"{begin}-{'' if end is None else end}"
+                                             for begin, end in self.requests()[0])}
+
+    def complete(self):
+        return not self.missing()
+
+    def write(self, position, data):
+        """Write data, which starts at position in the remote file, in the
+        ranges it belongs to. What was already received is skipped."""
+        last = position + len(data) - 1
+        for i, (begin, _) in enumerate(self.ranges):
+            start = begin + self.received[i]
+            end = self.end(i)
+            stop = last if end is None else min(end, last)
+            if start < position or start > stop:
+                continue
+            self.f.seek(self.offsets[i] + self.received[i])
+            self.f.write(data[start - position:stop - position + 1])
+            self.received[i] += stop - start + 1
+            self.written += stop - start + 1
+
+    def consume(self, r):
+        # Received of the last range, which can be open, before this answer
+        received = self.received[-1]
+        content_type = r.headers.get('Content-Type', '')
+        if r.status_code == 206 and content_type.startswith('multipart/byteranges'):
+            reader = MultipartReader()
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                for position, data, size in reader.feed(chunk):
+                    self.size = size or self.size
+                    self.write(position, data)
+        else:
+            if r.status_code == 206:
+                position, _, size = parse_content_range(r.headers.get('Content-Range', ''))
+            else:
+                # The server ignored the ranges and sent the whole file
+                position, size = 0, int(r.headers.get('Content-Length', 0)) or None
+            self.size = size or self.size
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                self.write(position, chunk)
+                position += len(chunk)
+        # When the size of the file is unknown (Content-Range bytes a-b/*) an
+        # open range ends where a complete answer for it ends
+        if self.size is None and self.ranges[-1][1] is None and self.received[-1] > received:
+            self.size = self.ranges[-1][0] + self.received[-1]
+
+
+class MultipartReader():
+    """Incremental parser of multipart/byteranges answers. feed() returns the
+    pieces of data received so far as (position in the remote file, data,
+    size of the remote file). The size of every part is known from its
+    Content-Range header, so the data is never searched for the boundary."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = None
+        self.size = None
+        self.remaining = 0
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+        pieces = []
+        while True:
+            if self.remaining == 0:
+                # Headers of the next part (the boundary is the first line)
+                headers_end = self.buffer.find(b"\r\n\r\n")
+                if headers_end < 0:
+                    break
+                headers = bytes(self.buffer[:headers_end]).decode('latin-1')
+                del self.buffer[:headers_end + 4]
+                self.position, end, self.size = parse_content_range(headers)
+                self.remaining = end - self.position + 1
+            elif self.buffer:
+                data = bytes(self.buffer[:self.remaining])
+                del self.buffer[:len(data)]
+                pieces.append((self.position, data, self.size))
+                self.position += len(data)
+                self.remaining -= len(data)
+            else:
+                break
+
+        return pieces
+
+
+def parse_content_range(headers):
+    """Get begin, end and size of the file (None if unknown) from a
+    Content-Range (either the headers of a part or the value of the header)."""
+    match = re.search(r"bytes\s+(\d+)-(\d+)/(\d+|\*)", headers)
+    if match is None:
+        raise ValueError(f'Invalid Content-Range in {headers}')
+    size = None if match.group(3) == '*' else int(match.group(3))
+
+    return int(match.group(1)), int(match.group(2)), size
+
+
 if __name__ == "__main__":
     main()
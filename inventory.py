@@ -0,0 +1,84 @@
+from functools import lru_cache
+import numpy as np
+import hashlib
+import re
+
+"""
+Parse the .idx inventories of the GRIB files on NOMADS and select the
+messages to download. Every line of an inventory looks like
+    1:0:d=2022082606:PRMSL:mean sea level:3 hour fcst:
+and is parsed with a single regular expression into NumPy arrays. The
+variables and levels to download are compiled only once into a set, so
+that selecting the messages of every forecast hour is just a lookup.
+"""
+
+line_regex = re.compile(r'^(\d+):(\d+):([^:\n]*):([^:\n]*):([^:\n]*):([^:\n]*):?(.*)$', re.MULTILINE)
+# Only select istantaneous and accumulated values (cause preciptation also has average)
+fcst_regex = re.compile(r'^\d+ hour fcst|^0-\d+ (?:hour|day) acc fcst')
+
+
+class Inventory():
+    """Messages of a GRIB file as arrays. The end of the last message is
+    not known (-1): it has to be requested as an open range."""
+
+    def __init__(self, text):
+        fields = np.array(line_regex.findall(text), dtype=str).reshape(-1, 7)
+        self.begin = fields[:, 1].astype(np.int64)
+        self.end = np.append(self.begin[1:] - 1, -1)
+        self.date = fields[:, 2]
+        self.var = fields[:, 3]
+        self.level = fields[:, 4]
+        self.fcst = fields[:, 5]
+
+    def __len__(self):
+        return len(self.begin)
+
+    def messages(self, indices):
+        """Selected messages as dictionaries, with a checksum of their line:
+        if the file changes on the server, the position of the message does too."""
+        messages = []
+        for i in indices:
+            end = None if self.end[i] < 0 else int(self.end[i])
+            line = f"{self.begin[i]}:{'' if end is None else end}:{self.date[i]}:" \
+                   f"{self.var[i]}:{self.level[i]}:{self.fcst[i]}"
+            messages.append(dict(var=str(self.var[i]), level=str(self.level[i]),
+                                 fcst=str(self.fcst[i]), begin=int(self.begin[i]), end=end,
+                                 hash=hashlib.md5(line.encode()).hexdigest()[:12]))
+        return messages
+
+
+class Selection():
+    """Variables and levels (in pairs) to download from every inventory.
+    Duplicated messages (same variable, level and forecast) are taken once."""
+
+    def __init__(self, variables, levels, fcst=fcst_regex):
+        if len(variables) != len(levels):
+            raise ValueError('Variables and levels should have the same size')
+        self.keys = set(zip(variables, levels))
+        self.fcst = fcst
+        # The same forecast types are found in many inventories
+        self.fcst_matches = {}
+
+    def match_fcst(self, fcst):
+        if fcst not in self.fcst_matches:
+            self.fcst_matches[fcst] = self.fcst.search(fcst) is not None
+        return self.fcst_matches[fcst]
+
+    def select(self, inventory):
+        """Indices of the selected messages in the inventory."""
+        indices = []
+        seen = set()
+        for i, key in enumerate(zip(inventory.var.tolist(), inventory.level.tolist(),
+                                    inventory.fcst.tolist())):
+            if (key[:2] in self.keys) and (key not in seen) and self.match_fcst(key[2]):
+                seen.add(key)
+                indices.append(i)
+
+        return np.array(indices, dtype=int)
+
+
+@lru_cache(maxsize=256)
+def parse(text):
+    """Parsed inventory, cached as the same text can be parsed many times
+    (e.g. when a forecast hour is downloaded again)."""
+    return Inventory(text)
@@ -0,0 +1,267 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from functools import lru_cache
+import argparse
+import threading
+import random
+import json
+import time
+import re
+
+"""
+Local stand-in for the NOMADS server, used to test and benchmark
+downloader.py without hitting the real one. It serves synthetic .idx
+inventories and GRIB files (every message starts with GRIB and ends with
+7777), honours single and multiple Range requests and can inject the
+throttling of the real server: 403 answers, empty bodies, dropped
+connections, latency and limited bandwidth. Counters are available
+at /stats. Start it with e.g.
+    python nomads_server.py --port 8000 --forbidden 0.05 --latency 0.2
+and point the downloader to it with -u http://localhost:8000/
+"""
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--host', help='Address to listen to', default='localhost')
+parser.add_argument('--port', help='Port to listen to', default=8000, type=int)
+parser.add_argument('--size', help='Mean size of a GRIB message (bytes)',
+                    default=100000, type=int)
+parser.add_argument('--extra', help='Messages not requested by get_grib.run in every file',
+                    default=100, type=int)
+parser.add_argument('--forbidden', help='Probability of answering 403',
+                    default=0., type=float)
+parser.add_argument('--empty', help='Probability of answering with an empty body',
+                    default=0., type=float)
+parser.add_argument('--drop', help='Probability of dropping the connection while sending',
+                    default=0., type=float)
+parser.add_argument('--latency', help='Seconds before answering',
+                    default=0., type=float)
+parser.add_argument('--bandwidth', help='MB/s for every connection (0 = unlimited)',
+                    default=0., type=float)
+parser.add_argument('--max-connections', help='Concurrent requests above which we answer 403 '
+                    '(0 = unlimited)', default=0, type=int)
+parser.add_argument('--max-rate', help='Requests per second (over the last 10 s) above which '
+                    'we answer 403 (0 = unlimited)', default=0., type=float)
+parser.add_argument('--max-ranges', help='Ranges in a request above which the whole file '
+                    'is sent, as done by Apache', default=200, type=int)
+
+boundary = 'NOMADS_STAND_IN'
+levels = ['10 mb', '50 mb', '150 mb', '250 mb', '300 mb', '500 mb', '700 mb', '850 mb', '1000 mb']
+# Filler used for the content of the messages
+block = random.Random(0).randbytes(1024 * 1024)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, StandInHandler)
+        self.options = options
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = dict(requests=0, idx=0, grib=0, ranges=0, bytes=0,
+                              forbidden=0, empty=0, dropped=0)
+            self.active = 0
+            self.history = []
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def throttle(self):
+        """Decide whether this request is refused, as NOMADS does when a
+        client opens too many connections or makes too many requests."""
+        options = self.options
+        now = time.time()
+        with self.lock:
+            self.history = [t for t in self.history if t > now - 10.] + [now]
+            if options.max_connections and self.active > options.max_connections:
+                return True
+            if options.max_rate and len(self.history) > options.max_rate * 10.:
+                return True
+        return random.random() < options.forbidden
+
+
+@lru_cache(maxsize=512)
+def get_inventory(date, run, fcst, size, extra):
+    """Messages (var, level, fcst, begin, end) of a synthetic GRIB file, with
+    the variables downloaded by get_grib.run among other ones."""
+    hour = int(fcst[1:])
+    messages = [('PRMSL', 'mean sea level', f'{hour} hour fcst')]
+    for var in ['HGT', 'TMP', 'RH', 'UGRD', 'VGRD']:
+        messages += [(var, level, f'{hour} hour fcst') for level in levels]
+    messages += [('TMP', '2 m above ground', f'{hour} hour fcst'),
+                 ('SNOD', 'surface', f'{hour} hour fcst'),
+                 ('CRAIN', 'surface', f'{hour} hour fcst'),
+                 ('CRAIN', 'surface', f'{hour - 3}-{hour} hour ave fcst'),
+                 ('CSNOW', 'surface', f'{hour} hour fcst'),
+                 ('PRATE', 'surface', f'{hour} hour fcst'),
+                 ('PRATE', 'surface', f'{hour - 3}-{hour} hour ave fcst'),
+                 ('APCP', 'surface', f'0-{hour} hour acc fcst'),
+                 ('APCP', 'surface', f'{hour - 3}-{hour} hour acc fcst'),
+                 ('TCDC', 'entire atmosphere', f'{hour} hour fcst'),
+                 ('TCDC', 'entire atmosphere', f'{hour - 3}-{hour} hour ave fcst'),
+                 ('HGT', '0C isotherm', f'{hour} hour fcst')]
+    rng = random.Random(f'{date}{run}{fcst}')
+    # Other variables are mixed in between, the last message is never requested
+    for i in range(extra):
+        messages.insert(rng.randint(1, len(messages)), (f'VAR{i}', 'surface', f'{hour} hour fcst'))
+    messages.append(('LAST', 'surface', f'{hour} hour fcst'))
+
+    inventory = []
+    begin = 0
+    for var, level, fcst_type in messages:
+        end = begin + max(int(rng.gauss(size, size / 4)), 8) - 1
+        inventory.append((var, level, fcst_type, begin, end))
+        begin = end + 1
+
+    return inventory
+
+
+def get_idx(date, run, inventory):
+    return ''.join(f'{i + 1}:{begin}:d={date}{run}:{var}:{level}:{fcst}:\n'
+                   for i, (var, level, fcst, begin, end) in enumerate(inventory))
+
+
+def get_data(inventory, begin, end):
+    """Bytes from begin to end (included) of the synthetic GRIB file."""
+    out = bytearray()
+    for _, _, _, message_begin, message_end in inventory:
+        if message_end < begin or message_begin > end:
+            continue
+        length = message_end - message_begin + 1
+        offset = message_begin % len(block)
+        filler = (block[offset:] + block)[:length - 8]
+        message = b'GRIB' + filler + b'7777'
+        out += message[max(begin - message_begin, 0):end - message_begin + 1]
+
+    return bytes(out)
+
+
+def parse_ranges(header, size):
+    """List of (begin, end) from a Range header, None if not satisfiable."""
+    match = re.fullmatch(r'\s*bytes=(.+)', header)
+    if match is None:
+        return None
+    ranges = []
+    for spec in match.group(1).split(','):
+        first, _, last = spec.strip().partition('-')
+        if not first:
+            begin, end = max(size - int(last), 0), size - 1
+        else:
+            begin = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if begin > end or begin >= size:
+            return None
+        ranges.append((begin, end))
+
+    return ranges
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Needed to keep the connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.add(requests=1)
+        with server.lock:
+            server.active += 1
+        try:
+            self.answer()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def answer(self):
+        server, options = self.server, self.server.options
+        if self.path == '/stats':
+            return self.send(200, json.dumps(server.stats).encode(), 'application/json')
+        if server.throttle():
+            server.add(forbidden=1)
+            return self.send(403, b'Forbidden')
+        time.sleep(options.latency)
+
+        match = re.fullmatch(r'.*/gfs\.(\d{8})/(\d{2})/atmos/gfs\.t\d{2}z\.pgrb2\.0p25\.(f\d{3})(\.idx)?',
+                             self.path)
+        if match is None:
+            return self.send(404, b'Not found')
+        date, run, fcst, idx = match.groups()
+        inventory = get_inventory(date, run, fcst, options.size, options.extra)
+        if random.random() < options.empty:
+            server.add(empty=1)
+            return self.send(200, b'')
+        if idx:
+            server.add(idx=1)
+            return self.send(200, get_idx(date, run, inventory).encode(), 'text/plain')
+
+        server.add(grib=1)
+        size = inventory[-1][4] + 1
+        if 'Range' not in self.headers:
+            return self.send(200, get_data(inventory, 0, size - 1))
+        ranges = parse_ranges(self.headers['Range'], size)
+        if ranges is None:
+            return self.send(416, b'Requested range not satisfiable',
+                             headers={'Content-Range': f'bytes */{size}'})
+        if len(ranges) > options.max_ranges:
+            return self.send(200, get_data(inventory, 0, size - 1))
+        server.add(ranges=len(ranges))
+        if len(ranges) == 1:
+            begin, end = ranges[0]
+            return self.send(206, get_data(inventory, begin, end),
+                             headers={'Content-Range': f'bytes {begin}-{end}/{size}'})
+        body = b''.join(
+            f'\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+            f'Content-Range: bytes {begin}-{end}/{size}\r\n\r\n'.encode() +
+            get_data(inventory, begin, end)
+            for begin, end in ranges) + f'\r\n--{boundary}--\r\n'.encode()
+        return self.send(206, body, f'multipart/byteranges; boundary={boundary}')
+
+    def send(self, status, body, content_type='application/octet-stream', headers={}):
+        options = self.server.options
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        # Drop the connection somewhere in the middle of the data
+        if status in (200, 206) and body and random.random() < options.drop:
+            self.server.add(dropped=1, bytes=len(body) // 2)
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        chunk = 64 * 1024
+        for i in range(0, len(body), chunk):
+            self.wfile.write(body[i:i + chunk])
+            if options.bandwidth:
+                time.sleep(chunk / (options.bandwidth * 1024. ** 2))
+        self.server.add(bytes=len(body))
+
+
+def start(options):
+    """Start the server in a background thread and return it."""
+    server = StandInServer((options.host, options.port), options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def main():
+    options = parser.parse_args()
+    server = StandInServer((options.host, options.port), options)
+    print(f'Serving on http://{options.host}:{server.server_address[1]}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
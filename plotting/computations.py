@@ -1,21 +1,23 @@
 import metpy.calc as mpcalc
+import metpy.constants as mpconsts
 import xarray as xr
+import numpy as np
 from metpy.units import units
+import grid_metrics
 
 
 def compute_spacing(dset):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'],
-                                        dset['lat'])
+    metrics = grid_metrics.get(dset['lon'].values, dset['lat'].values)
 
-    dx = xr.DataArray(dx.magnitude,
+    dx = xr.DataArray(metrics['dx'],
                       dims=['y1', 'x1'],
                       attrs={'standard_name': 'x grid spacing',
-                             'units': dx.units},
+                             'units': units.meter},
                       name='dx')
-    dy = xr.DataArray(dy.magnitude,
+    dy = xr.DataArray(metrics['dy'],
                       dims=['y2', 'x2'],
                       attrs={'standard_name': 'y grid spacing',
-                             'units': dx.units},
+                             'units': units.meter},
                       name='dy')
 
     out = xr.merge([dset, dx, dy])
@@ -24,6 +26,13 @@ def compute_spacing(dset):
     return out
 
 
+def get_grid_deltas(dset):
+    """dx, dy as MetPy quantities, from the grid metrics (see grid_metrics.py)."""
+    metrics = grid_metrics.get(dset['lon'].values, dset['lat'].values)
+
+    return metrics['dx'] * units.meter, metrics['dy'] * units.meter
+
+
 def compute_theta(dset, tvar='t'):
     pres = dset['plev'].metpy.unit_array
     theta = mpcalc.potential_temperature(pres[:, None, None], dset[tvar])
@@ -68,7 +77,7 @@ def compute_pv(dset):
 
 
 def compute_convergence(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
+    dx, dy = get_grid_deltas(dset)
     conv = - mpcalc.divergence(dset[uvar], dset[vvar],
                                dx[None, :, :],
                                dy[None, :, :])
@@ -82,7 +91,7 @@ def compute_convergence(dset, uvar='10u', vvar='10v'):
 
 
 def compute_vorticity(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
+    dx, dy = get_grid_deltas(dset)
     vort = mpcalc.vorticity(dset[uvar], dset[vvar],
                             dx[None, :, :],
                             dy[None, :, :])
@@ -209,3 +218,51 @@ def compute_soil_moisture_sat(dset, projection):
     w_so_sat = w_so_sat.where(w_so != 0, 0.)
 
     return xr.merge([dset, w_so_sat])
+
+
+def compute_pv_levels(dset, tvar='theta'):
+    """Potential vorticity (as potential_vorticity_baroclinic in MetPy) for all
+    time steps at once, only on the levels that have a level above and one
+    below, with plain float32 arrays. The horizontal metrics come from
+    grid_metrics."""
+    pres = dset['plev'].values.astype(np.float64)
+    if len(pres) < 3:
+        raise ValueError('At least 3 levels are needed to compute PV')
+    lats = dset['lat'].values
+    theta = dset[tvar].transpose(..., 'plev', 'lat', 'lon').values.astype(np.float32)
+    u = dset['u'].transpose(..., 'plev', 'lat', 'lon').values.astype(np.float32)
+    v = dset['v'].transpose(..., 'plev', 'lat', 'lon').values.astype(np.float32)
+
+    metrics = grid_metrics.get(dset['lon'].values, lats)
+    ddp = grid_metrics.get_stencil(np.diff(pres), axis=-3)
+    ddx, ddy = metrics['ddx'], metrics['ddy']
+    # Only the derivatives in the inner levels are needed
+    inner = slice(1, -1)
+    dthetadp = grid_metrics.first_derivative(theta, ddp)[..., inner, :, :]
+    dudp = grid_metrics.first_derivative(u, ddp)[..., inner, :, :]
+    dvdp = grid_metrics.first_derivative(v, ddp)[..., inner, :, :]
+    theta, u, v = theta[..., inner, :, :], u[..., inner, :, :], v[..., inner, :, :]
+    # Derivatives on the sphere, with the same map factor corrections done by
+    # MetPy when the winds are passed as DataArrays
+    parallel, meridional = metrics['parallel_scale'], metrics['meridional_scale']
+    dx_correction, dy_correction = metrics['dx_correction'], metrics['dy_correction']
+    dthetadx = parallel * grid_metrics.first_derivative(theta, ddx)
+    dthetady = meridional * grid_metrics.first_derivative(theta, ddy)
+    dvdx = parallel * grid_metrics.first_derivative(v, ddx) + u * dx_correction
+    dudy = meridional * grid_metrics.first_derivative(u, ddy) + v * dy_correction
+    avor = dvdx - dudy + metrics['f'][:, None].astype(np.float32)
+    g = float(mpconsts.g.magnitude)
+    pv = -g * (dudp * dthetady - dvdp * dthetadx + avor * dthetadp)
+
+    coords = dset['u'].transpose(..., 'plev', 'lat', 'lon').isel(plev=inner).coords
+    pv = xr.DataArray(pv,
+                      coords=coords,
+                      dims=dset['u'].transpose(..., 'plev', 'lat', 'lon').dims,
+                      attrs={'standard_name': 'Potential Vorticity',
+                             'units': 'kelvin * meter ** 2 / kilogram / second'},
+                      name='pv')
+
+    out = xr.merge([dset, pv])
+    out.attrs = dset.attrs
+
+    return out
@@ -0,0 +1,170 @@
+import computations
+import kernels
+import xarray as xr
+import utils
+import pickle
+import os
+from collections import OrderedDict
+
+"""
+Registry of the fields derived from the variables of the dataset. Every
+field is declared with the fields (or variables) it is computed from, e.g.
+    theta <- t
+    pv <- theta, u, v
+and computed only when requested by a product, together with the fields
+it needs which are not already known. Every result is memoised by run,
+projection and grid/time steps of the variables it comes from, so that a
+field shared by many products (e.g. MSLP in hPa) is computed only once per
+run when the products are rendered by the same process (see render_all.py).
+"""
+
+registry = {}
+
+# Results kept in memory up to this size in bytes, the oldest are dropped
+# first (a field of a whole run on the nh_polar grid takes a few hundred MB)
+max_memoised_bytes = 2 * 1024 ** 3
+memoised = OrderedDict()
+# Save the results also in the cache folder, so that they can be shared
+# between processes (e.g. when the scripts are started one by one)
+on_disk = False
+
+
+def field(name, *inputs):
+    """Decorator to register the function computing a derived field from its
+    inputs (derived fields or variables of the dataset, in this order)."""
+    def register(function):
+        registry[name] = (inputs, function)
+        return function
+
+    return register
+
+
+def conversion(name, var, units):
+    """Register a field which is only var converted to other units."""
+    registry[name] = ((var,), lambda data: kernels.convert_units(data, units))
+
+
+conversion('prmsl_hPa', 'prmsl', 'hPa')
+conversion('gh_dam', 'gh', 'dam')
+conversion('t_degC', 't', 'degC')
+conversion('sde_cm', 'sde', 'cm')
+conversion('gh_2_m', 'gh_2', 'm')
+conversion('prate_mmh', 'prate', 'kilogram / meter ** 2 / hour')
+
+
+@field('theta', 't')
+def theta(t):
+    return kernels.add_theta(xr.Dataset({'t': t}))['theta']
+
+
+@field('pv', 'theta', 'u', 'v')
+def pv(theta, u, v):
+    # All time steps at once, only on the levels between the first and the last
+    dset = xr.merge([theta, u, v])
+    return computations.compute_pv_levels(dset)['pv'].sel(plev=dset['plev'][1:-1])
+
+
+@field('rain_rate', 'prate_mmh', 'crain')
+def rain_rate(prate, crain):
+    return kernels.like(prate, kernels.rate(prate.values, crain.values), 'rain_rate', prate.attrs)
+
+
+@field('snow_rate', 'prate_mmh', 'csnow')
+def snow_rate(prate, csnow):
+    return kernels.like(prate, kernels.rate(prate.values, csnow.values), 'snow_rate', prate.attrs)
+
+
+@field('snow_increment', 'sde_cm')
+def snow_increment(sde):
+    return kernels.add_snow_change(xr.Dataset({'sde': sde}))['snow_increment']
+
+
+def plan(names):
+    """Derived fields needed to compute names, in the order they have to be
+    computed (the variables of the dataset are not included)."""
+    order = []
+
+    def visit(name):
+        if (name in order) or (name not in registry):
+            return
+        for i in registry[name][0]:
+            visit(i)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+
+    return order
+
+
+def compute(dset, projection, **fields):
+    """Assign the derived fields to the variables of dset, e.g.
+    compute(dset, projection, prmsl='prmsl_hPa') replaces prmsl with MSLP in hPa.
+    All fields are computed before being assigned, so a variable can be
+    replaced by a field computed from it."""
+    results = {}
+    values = {var: get(dset, projection, name, results) for var, name in fields.items()}
+    for var, value in values.items():
+        dset[var] = value
+
+    return dset
+
+
+def get(dset, projection, name, results=None):
+    """Value of a field (or variable) of dset, computed only if it was not
+    memoised. results keeps the fields computed by the same request."""
+    if name not in registry:
+        return dset[name]
+    results = {} if results is None else results
+    if name in results:
+        return results[name]
+
+    key = get_key(dset, projection, name)
+    value = memoised.get(key)
+    if value is None and on_disk:
+        value = read(key, projection)
+    if value is None:
+        inputs, function = registry[name]
+        value = function(*[get(dset, projection, i, results) for i in inputs]).load()
+        if on_disk:
+            utils.write_cache(get_filename(key, projection), value)
+    memoise(key, value)
+    results[name] = value
+
+    return value
+
+
+def memoise(key, value):
+    """Keep value in memory, dropping the oldest values (also this one if it
+    is larger than max_memoised_bytes alone)."""
+    memoised[key] = value
+    memoised.move_to_end(key)
+    size = sum(v.nbytes for v in memoised.values())
+    while memoised and size > max_memoised_bytes:
+        size -= memoised.popitem(last=False)[1].nbytes
+
+
+def get_key(dset, projection, name):
+    """The same field is the same as long as the run, the projection and
+    the coordinates of the variables it is computed from do not change."""
+    variables = sorted({i for field in plan([name]) for i in registry[field][0]
+                        if i not in registry})
+    coords = []
+    for var in variables:
+        for dim in dset[var].dims:
+            values = dset[dim].values
+            coords.append((var, dim, len(values), str(values[0]), str(values[-1])))
+
+    return (str(dset['run'].values), projection, name, tuple(coords))
+
+
+def get_filename(key, projection):
+    return utils.get_cache_filename(projection, 'derived', key)
+
+
+def read(key, projection):
+    filename = get_filename(key, projection)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,143 @@
+import metpy.calc as mpcalc
+import metpy.constants as mpconsts
+import numpy as np
+from pyproj import CRS, Proj
+from collections import OrderedDict
+import hashlib
+import utils
+import os
+
+"""
+Metrics of a regular lat/lon grid: spacing (dx, dy), Coriolis parameter,
+map factors and the finite difference stencils built from them. They only
+depend on the grid, which does not change from run to run, so they are
+computed once, kept in memory and saved in the cache folder as .npy files
+named after the hash of the grid. Use
+    metrics = grid_metrics.get(dset['lon'].values, dset['lat'].values)
+    dtdx = grid_metrics.first_derivative(t, metrics['ddx'])
+"""
+
+# Grids kept in memory, the oldest are dropped first
+max_memoised = 16
+memoised = OrderedDict()
+# Arrays saved to disk, the stencils are rebuilt from dx and dy
+saved = ['dx', 'dy', 'f', 'parallel_scale', 'meridional_scale']
+
+
+def get_key(lons, lats):
+    """Hash of the grid coordinates."""
+    lons = np.ascontiguousarray(lons, dtype=np.float64)
+    lats = np.ascontiguousarray(lats, dtype=np.float64)
+    definition = repr((lons.shape, lats.shape)).encode() + lons.tobytes() + lats.tobytes()
+
+    return hashlib.md5(definition).hexdigest()[:12]
+
+
+def get_filename(key, name):
+    return utils.cache_folder + 'grid_%s_%s.npy' % (key, name)
+
+
+def get(lons, lats):
+    """Metrics of the grid with 1D coordinates lons, lats (dict of arrays
+    with dims (lat, lon), f only along lat):
+        dx, dy: spacing in m as given by lat_lon_grid_deltas
+        f: Coriolis parameter in 1/s
+        parallel_scale, meridional_scale: map factors (float32)
+        ddx, ddy: stencils of the derivatives along lon, lat (see get_stencil)
+        dx_correction, dy_correction: map factor terms added to the derivatives
+        of the wind components, as in MetPy's vector_derivative"""
+    key = get_key(lons, lats)
+    metrics = memoised.get(key)
+    if metrics is None:
+        metrics = read(key)
+    if metrics is None:
+        metrics = compute(lons, lats)
+        for name in saved:
+            utils.write_cache(get_filename(key, name), metrics[name])
+    if 'ddx' not in metrics:
+        metrics.update(get_derivatives(metrics))
+    memoised[key] = metrics
+    memoised.move_to_end(key)
+    while len(memoised) > max_memoised:
+        memoised.popitem(last=False)
+
+    return metrics
+
+
+def read(key):
+    filenames = [get_filename(key, name) for name in saved]
+    if not all(os.path.isfile(filename) for filename in filenames):
+        return None
+
+    return {name: np.load(filename) for name, filename in zip(saved, filenames)}
+
+
+def compute(lons, lats):
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    dx, dy = mpcalc.lat_lon_grid_deltas(lons, lats)
+    f = 2 * mpconsts.omega.magnitude * np.sin(np.deg2rad(lats))
+    # Same map factors used by MetPy for DataArrays on a lat/lon grid
+    factors = Proj(CRS('+proj=latlon')).get_factors(*np.meshgrid(lons, lats))
+
+    return {'dx': np.asarray(dx.m_as('m')),
+            'dy': np.asarray(dy.m_as('m')),
+            'f': f,
+            'parallel_scale': factors.parallel_scale.astype(np.float32),
+            'meridional_scale': factors.meridional_scale.astype(np.float32)}
+
+
+def get_derivatives(metrics):
+    """Stencils and map factor corrections, which are cheap to compute from
+    the other metrics and are not saved."""
+    ddx = get_stencil(metrics['dx'], axis=-1)
+    ddy = get_stencil(metrics['dy'], axis=-2)
+    parallel, meridional = metrics['parallel_scale'], metrics['meridional_scale']
+
+    return {'ddx': ddx, 'ddy': ddy,
+            'dx_correction': meridional / parallel * first_derivative(parallel, ddy),
+            'dy_correction': parallel / meridional * first_derivative(meridional, ddx)}
+
+
+def get_stencil(delta, axis):
+    """Indices and weights of the second order finite differences used by
+    MetPy's first_derivative along axis (negative, counted from the end),
+    for the spacing delta between the points (which can also change along
+    the other axes). They only depend on the grid, so they can be computed
+    once and applied to many fields (see first_derivative)."""
+    delta = np.asarray(delta, dtype=np.float64)
+    if delta.ndim > 1:
+        delta = np.moveaxis(delta, axis, 0)
+    n = delta.shape[0] + 1
+    # Centered differences inside, one sided at the edges
+    d0, d1 = delta[:-1], delta[1:]
+    combined = d0 + d1
+    inside = (-d1 / (combined * d0), (d1 - d0) / (d0 * d1), d0 / (combined * d1))
+    combined = delta[0] + delta[1]
+    big_delta = combined + delta[0]
+    left = (-big_delta / (combined * delta[0]), combined / (delta[0] * delta[1]),
+            -delta[0] / (combined * delta[1]))
+    combined = delta[-2] + delta[-1]
+    big_delta = combined + delta[-1]
+    right = (delta[-1] / (combined * delta[-2]), -combined / (delta[-2] * delta[-1]),
+             big_delta / (combined * delta[-1]))
+
+    indices = [np.r_[0, np.arange(0, n - 2), n - 3],
+               np.r_[1, np.arange(1, n - 1), n - 2],
+               np.r_[2, np.arange(2, n), n - 1]]
+    weights = [np.concatenate([l[None], i, r[None]]).astype(np.float32)
+               for l, i, r in zip(left, inside, right)]
+    if delta.ndim > 1:
+        weights = [np.moveaxis(w, 0, axis) for w in weights]
+    else:
+        # Broadcast along the axes after axis
+        weights = [w.reshape((-1,) + (1,) * (-axis - 1)) for w in weights]
+
+    return axis, indices, weights
+
+
+def first_derivative(f, stencil):
+    """Derivative of the array f along the axis of stencil (see get_stencil)."""
+    axis, indices, weights = stencil
+
+    return sum(w * np.take(f, i, axis=axis) for i, w in zip(indices, weights))
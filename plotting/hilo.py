@@ -0,0 +1,93 @@
+from scipy.ndimage import maximum_filter1d
+from sprites import Labels
+import numpy as np
+
+"""
+Relative maxima/minima of a field and their H/L labels (see
+utils.plot_maxmin_points). A point is an extremum when it is the largest
+(smallest) value in the window of nsize points centered on it, the same
+result of scipy's maximum_filter but found on a field coarsened in blocks
+and then checked on the full field only around the candidates. Instead of
+adding random noise to break the ties of flat areas, only the first point
+(ordered by value and then by position) is kept among the ones closer than
+half a window (and flat areas have no extrema), so the result is always
+the same. The symbols of all the extrema are drawn by a single artist (and
+their values by another one), see sprites.py.
+"""
+
+# The blocks used to coarsen the field are this much smaller than the window
+coarsening = 8
+
+
+def find(data, extrema, nsize):
+    """Rows and columns of the maxima (extrema='max') or minima ('min') of
+    data in windows of nsize points, from the most intense."""
+    if extrema == 'max':
+        field = np.asarray(data, dtype=np.float32)
+    elif extrema == 'min':
+        field = -np.asarray(data, dtype=np.float32)
+    else:
+        raise ValueError('Value for hilo must be either max or min')
+    rows, columns = get_candidates(field, nsize)
+    # Window around every point as in scipy.ndimage (mode='nearest'), which
+    # must not be flat
+    before, after = nsize // 2, nsize - nsize // 2
+    keep = []
+    for row, column in zip(rows, columns):
+        window = field[max(row - before, 0):row + after, max(column - before, 0):column + after]
+        keep.append(field[row, column] >= window.max() > window.min())
+    rows, columns = rows[keep], columns[keep]
+    # Points on the first row/column are not used
+    inside = (rows != 0) & (columns != 0)
+    rows, columns = rows[inside], columns[inside]
+    order = np.lexsort((columns, rows, -field[rows, columns]))
+
+    return suppress(rows[order], columns[order], min(before, after - 1))
+
+
+def get_candidates(field, nsize):
+    """Points which can be extrema: the largest ones of every block of the
+    coarsened field which is also the largest in the (coarse) window
+    contained in the window of nsize points around it."""
+    step = max(nsize // coarsening, 1)
+    ny, nx = field.shape
+    padded = np.full((-(-ny // step) * step, -(-nx // step) * step), -np.inf, dtype=field.dtype)
+    padded[:ny, :nx] = np.where(np.isnan(field), -np.inf, field)
+    blocks = padded.reshape(padded.shape[0] // step, step, padded.shape[1] // step, step)
+    blocks = blocks.transpose(0, 2, 1, 3).reshape(padded.shape[0] // step, padded.shape[1] // step, -1)
+    coarse = blocks.max(axis=-1)
+    # Blocks always inside the window of any point of the central one
+    size = 2 * max((min(nsize // 2, nsize - nsize // 2 - 1) - step + 1) // step, 0) + 1
+    filtered = maximum_filter1d(maximum_filter1d(coarse, size, axis=0, mode='nearest'),
+                                size, axis=1, mode='nearest')
+    by, bx = np.nonzero((coarse == filtered) & np.isfinite(coarse))
+    # All the points of the block with its largest value
+    block, inside = np.nonzero(blocks[by, bx] == coarse[by, bx, None])
+
+    return by[block] * step + inside // step, bx[block] * step + inside % step
+
+
+def suppress(rows, columns, distance):
+    """Drop the points closer than distance (in both directions) to one
+    of the previous ones."""
+    kept = []
+    for i in range(len(rows)):
+        if not any(abs(rows[i] - rows[j]) <= distance and abs(columns[i] - columns[j]) <= distance
+                   for j in kept):
+            kept.append(i)
+
+    return rows[kept], columns[kept]
+
+
+def labels(ax, lon, lat, data, extrema, nsize, symbol, color='k'):
+    """Artists with the symbol (in color) and the value of every extremum."""
+    rows, columns = find(data, extrema, nsize)
+    x, y = np.asarray(lon)[rows, columns], np.asarray(lat)[rows, columns]
+    values = [str(int(value)) for value in np.asarray(data)[rows, columns]]
+    symbols = Labels(ax, x, y, [symbol] * len(rows), color=color, size=15, stroke='black')
+    texts = Labels(ax, x, y, ['\n' + value for value in values], color='gray', size=10,
+                   weight='bold', va='top')
+    ax.add_artist(symbols)
+    ax.add_artist(texts)
+
+    return [symbols, texts]
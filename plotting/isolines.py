@@ -0,0 +1,129 @@
+from matplotlib.contour import ContourSet
+import contourpy
+import numpy as np
+import pickle
+import utils
+import os
+
+"""
+Line contours shared between projections. The isolines of a field on the
+lat/lon grid do not depend on the map, so for the products listed in
+utils.isolines_products they are computed (with contourpy, in lon/lat) only
+on the grid of the first projection listed, which contains the others, and
+saved in the cache folder for every run, time step and level. The other
+projections read them, keep the parts inside their own grid and project them
+on their map, instead of contouring again. Their grid is a cutout of the same
+grid, so the lines are the same that ax.contour would find. Use
+    c = isolines.contour(ax, x, y, data, variable_name, projection, run,
+                         levels=levels, colors='white', linewidths=1)
+which is the same as ax.contour(x, y, data, ...) when the product is not listed
+for the projection, when data has no lon/lat coordinates, when the field was
+averaged (the averaged grids of the projections are not aligned, see
+utils.coarsen_dataset) or when the lines of some levels were not saved (yet).
+The lines of every run are saved in a subfolder of cache_folder/isolines/,
+removed by get_grib.run after plotting.
+"""
+
+
+def get_parent(product, projection):
+    """Projection whose lines are used by projection, None if not shared."""
+    projections = utils.isolines_products.get(product, [])
+    if projection not in projections:
+        return None
+
+    return projections[0]
+
+
+def contour(ax, x, y, data, product, projection, run, **kwargs):
+    """Same as ax.contour(x, y, data, **kwargs), with the lines shared between
+    projections if enabled for the product (see above)."""
+    parent = get_parent(product, projection)
+    if parent is None or 'lon' not in data.coords or data.attrs.get('coarsening', 1) > 1:
+        return ax.contour(x, y, data, **kwargs)
+
+    levels = np.asarray(kwargs.pop('levels'), dtype=np.float64)
+    filename = get_filename(data, product, run)
+    if projection == parent:
+        lines = compute_lines(data, levels)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        utils.write_cache(filename, lines)
+    else:
+        lines = read_lines(filename)
+        if lines is None or not all(level in lines for level in levels):
+            return ax.contour(x, y, data, levels=levels, **kwargs)
+    lat, lon = data['lat'].values, data['lon'].values
+    allsegs = [project(clip(lines[level], lon, lat), x, y) for level in levels]
+    if not any(allsegs):
+        return ax.contour(x, y, data, levels=levels, **kwargs)
+    # A level without lines still needs a (empty) path
+    allsegs = [segs or [np.empty((0, 2))] for segs in allsegs]
+
+    return ContourSet(ax, levels, allsegs, **kwargs)
+
+
+def get_filename(data, product, run):
+    """The lines of the same field of a product only change with the run, the
+    time step and the vertical level (if any)."""
+    name = [product, str(data.name), str(data['time'].values)]
+    if 'plev' in data.coords:
+        name.append(str(float(data['plev'])))
+
+    return utils.cache_folder + 'isolines/%s/%s.pkl' % (str(np.datetime64(run, 'h')),
+                                                       '_'.join(name).replace(':', ''))
+
+
+def compute_lines(data, levels):
+    """Isolines of every level as (lon, lat) arrays, {level: [lines]}."""
+    lon, lat = data['lon'].values, data['lat'].values
+    z = np.ma.masked_invalid(np.asarray(data, dtype=np.float64))
+    generator = contourpy.contour_generator(lon, lat, z, name='mpl2014', corner_mask=True,
+                                            line_type=contourpy.LineType.SeparateCode)
+
+    return {level: generator.lines(level)[0] for level in levels}
+
+
+def read_lines(filename):
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def clip(lines, lon, lat):
+    """Parts of the lines (lon/lat) inside the grid given by lon, lat, as
+    fractional indices (row, column) of the grid."""
+    # The vertices are on the edges of the grid, within the rounding errors
+    eps = 1e-6
+    rows, columns = len(lat) - 1, len(lon) - 1
+    clipped = []
+    for line in lines:
+        c = (line[:, 0] - lon[0]) / (lon[1] - lon[0])
+        r = (line[:, 1] - lat[0]) / (lat[1] - lat[0])
+        inside = (r >= -eps) & (r <= rows + eps) & (c >= -eps) & (c <= columns + eps)
+        if inside.all():
+            clipped.append(np.column_stack([r, c]))
+            continue
+        # Runs of consecutive vertices inside, with at least one segment
+        changes = np.flatnonzero(np.diff(inside.astype(np.int8))) + 1
+        for begin, end in zip(np.r_[0, changes], np.r_[changes, len(inside)]):
+            if inside[begin] and end - begin > 1:
+                clipped.append(np.column_stack([r[begin:end], c[begin:end]]))
+
+    return clipped
+
+
+def project(lines, x, y):
+    """Lines given as fractional indices of the grid on the projected grid x, y,
+    interpolated linearly as contourpy does along the edges of the cells."""
+    points = np.stack([x, y], axis=-1)
+    projected = []
+    for line in lines:
+        r = np.clip(line[:, 0], 0, x.shape[0] - 1)
+        c = np.clip(line[:, 1], 0, x.shape[1] - 1)
+        r0 = np.minimum(r.astype(int), x.shape[0] - 2)
+        c0 = np.minimum(c.astype(int), x.shape[1] - 2)
+        fr, fc = (r - r0)[:, None], (c - c0)[:, None]
+        projected.append(points[r0, c0] * (1 - fr) * (1 - fc) + points[r0 + 1, c0] * fr * (1 - fc) +
+                         points[r0, c0 + 1] * (1 - fr) * fc + points[r0 + 1, c0 + 1] * fr * fc)
+
+    return projected
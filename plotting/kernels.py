@@ -0,0 +1,204 @@
+import metpy.constants as mpconsts
+from metpy.units import units
+from functools import lru_cache
+import xarray as xr
+import numpy as np
+
+"""
+Unit-free versions of the helpers in computations.py. They work on plain
+float32 arrays whose units are known in advance (the ones of the GFS
+files, or the ones given in the arguments), write the result into out if
+given, and the add_* functions assign the result to the dataset instead
+of merging a new one. The formulas (and constants) are the same used by
+MetPy, so the results match the ones of computations.py within float32
+precision.
+"""
+
+# Constants as plain floats
+kappa = float(mpconsts.kappa.m_as('dimensionless'))
+g = float(mpconsts.g.m_as('m / s ** 2'))
+earth_radius = float(mpconsts.Re.m_as('m'))
+epsilon = float(mpconsts.epsilon.m_as('dimensionless'))
+t0 = float(mpconsts.T0.m_as('K'))
+zero_degc = float(units.Quantity(0., 'degC').m_as('K'))
+sat_pressure_0c = float(mpconsts.sat_pressure_0c.m_as('hPa'))
+lv = float(mpconsts.Lv.m_as('J / kg'))
+cp_l = float(mpconsts.Cp_l.m_as('J / kg / K'))
+cp_v = float(mpconsts.Cp_v.m_as('J / kg / K'))
+rv = float(mpconsts.Rv.m_as('J / kg / K'))
+reference_pressure = 1000.  # hPa
+
+
+@lru_cache(maxsize=64)
+def get_conversion(source, target):
+    """(scale, offset, name) to convert values from source to target units,
+    so that target = source * scale + offset. Only this is done with pint,
+    once for every couple of units."""
+    offset = units.Quantity(0., source).m_as(target)
+    scale = units.Quantity(1., source).m_as(target) - offset
+
+    return scale, offset, str(units.Unit(target))
+
+
+def get_array(data, dtype=np.float32):
+    return np.asarray(data.values if isinstance(data, xr.DataArray) else data, dtype=dtype)
+
+
+def like(data, values, name, attrs):
+    """DataArray with the values on the same coordinates of data."""
+    return xr.DataArray(values, coords=data.coords, dims=data.dims, name=name, attrs=attrs)
+
+
+def convert(values, source, target, out=None):
+    scale, offset, _ = get_conversion(source, target)
+    out = np.multiply(values, np.float32(scale), out=out)
+    if offset:
+        out += np.float32(offset)
+
+    return out
+
+
+def convert_units(data, target):
+    """Same as data.metpy.convert_units(target).metpy.dequantify()."""
+    _, _, name = get_conversion(data.attrs['units'], target)
+    values = convert(get_array(data), data.attrs['units'], target)
+
+    return like(data, values, data.name, dict(data.attrs, units=name))
+
+
+def theta(t, pres, out=None):
+    """Potential temperature (K) from temperature (K) and pressure (hPa),
+    which has to broadcast against t."""
+    pres = np.asarray(pres, dtype=np.float32)
+    exner = (pres / np.float32(reference_pressure)) ** np.float32(kappa)
+
+    return np.divide(t, exner, out=out)
+
+
+def saturation_vapor_pressure(t):
+    """Over liquid water, in hPa, from temperature in K."""
+    latent_heat = lv - (cp_l - cp_v) * (t - t0)
+    heat_power = (cp_l - cp_v) / rv
+    exp_term = (lv / t0 - latent_heat / t) / rv
+
+    return sat_pressure_0c * (t0 / t) ** heat_power * np.exp(exp_term)
+
+
+def dewpoint_from_relative_humidity(t, rh):
+    """Dewpoint (K) from temperature (K) and relative humidity (%)."""
+    val = np.log(rh / 100. * saturation_vapor_pressure(t) / sat_pressure_0c)
+
+    return zero_degc + 243.5 * val / (17.67 - val)
+
+
+def theta_e(t, rh, pres, out=None):
+    """Equivalent potential temperature (K) from temperature (K), relative
+    humidity (%) and pressure (hPa). Computed in float64 as the exponents
+    are sensitive to rounding."""
+    t = np.asarray(t, dtype=np.float64)
+    td = dewpoint_from_relative_humidity(t, np.asarray(rh, dtype=np.float64))
+    e = saturation_vapor_pressure(td)
+    r = epsilon * e / (pres - e)
+    t_l = 56 + 1. / (1. / (td - 56) + np.log(t / td) / 800.)
+    th_l = t / ((pres - e) / reference_pressure) ** kappa * (t / t_l) ** (0.28 * r)
+    values = th_l * np.exp(r * (1 + 0.448 * r) * (3036. / t_l - 1.78))
+    if out is None:
+        return values.astype(np.float32)
+    out[...] = values
+
+    return out
+
+
+def wind_speed(u, v, out=None):
+    """Wind speed in km/h from the components in m/s."""
+    out = np.hypot(u, v, out=out)
+    out *= np.float32(3.6)
+
+    return out
+
+
+def geopotential_to_height(z, out=None):
+    """Geopotential height (m) from geopotential (m**2/s**2)."""
+    out = np.multiply(z, np.float32(earth_radius), out=out)
+    out /= (np.float32(g * earth_radius) - z)
+
+    return out
+
+
+def rate(prate, mask, out=None):
+    """Precipitation rate where mask is 1 (e.g. crain), NaN elsewhere."""
+    if out is None:
+        out = np.array(prate, dtype=np.float32)
+    else:
+        out[...] = prate
+    out[mask != 1] = np.nan
+
+    return out
+
+
+def snow_change(sde, threshold=0.5, out=None):
+    """Change of snow depth since the first time step (axis 0), NaN
+    where smaller than threshold."""
+    out = np.subtract(sde, sde[0], out=out)
+    out[np.abs(out) <= threshold] = np.nan
+
+    return out
+
+
+def add_theta(dset, tvar='t'):
+    pres = convert(dset['plev'].values, dset['plev'].attrs.get('units', 'Pa'), 'hPa')
+    shape = [-1 if dim == 'plev' else 1 for dim in dset[tvar].dims]
+    t = convert(get_array(dset[tvar]), dset[tvar].attrs.get('units', 'K'), 'K')
+    dset['theta'] = like(dset[tvar], theta(t, pres.reshape(shape), out=t), 'theta',
+                         {'standard_name': 'Potential Temperature', 'units': 'K'})
+
+    return dset
+
+
+def add_thetae(dset, tvar='t', rvar='r', level=850.):
+    t = convert(get_array(dset[tvar]), dset[tvar].attrs.get('units', 'K'), 'K')
+    rh = convert(get_array(dset[rvar]), dset[rvar].attrs.get('units', '%'), 'percent')
+    values = theta_e(t, rh, level)
+    convert(values, 'K', 'degC', out=values)
+    dset['theta_e'] = like(dset[tvar], values, 'theta_e',
+                           {'standard_name': 'Equivalent potential temperature',
+                            'units': 'degree_Celsius'})
+
+    return dset
+
+
+def add_wind_speed(dset, uvar='u', vvar='v'):
+    dset['wind_speed'] = like(dset[uvar], wind_speed(get_array(dset[uvar]), get_array(dset[vvar])),
+                              'wind_speed', {'standard_name': 'wind intensity',
+                                             'units': 'kilometer_per_hour'})
+
+    return dset
+
+
+def add_geopot_height(dset, zvar='z', level=None):
+    zlevel = dset[zvar].sel(plev=level) if level else dset[zvar]
+    dset['geop'] = like(zlevel, geopotential_to_height(get_array(zlevel)), 'geop',
+                        {'standard_name': 'geopotential height', 'units': 'meter'})
+
+    return dset
+
+
+def add_rate(dset):
+    """Rain and snow rates in mm/h."""
+    prate = dset['prate']
+    _, _, name = get_conversion(prate.attrs['units'], 'kilogram / meter ** 2 / hour')
+    values = convert(get_array(prate), prate.attrs['units'], 'kilogram / meter ** 2 / hour')
+    for var, mask in [('rain_rate', 'crain'), ('snow_rate', 'csnow')]:
+        dset[var] = like(prate, rate(values, get_array(dset[mask])), var,
+                         dict(prate.attrs, units=name))
+
+    return dset
+
+
+def add_snow_change(dset, snowvar='sde'):
+    dset['snow_increment'] = like(dset[snowvar], snow_change(get_array(dset[snowvar])),
+                                  'snow_increment',
+                                  {'standard_name': 'Snow accumulation since beginning',
+                                   'units': dset[snowvar].attrs.get('units')})
+
+    return dset
@@ -0,0 +1,169 @@
+import matplotlib
+import matplotlib.image as mpimg
+from matplotlib.artist import Artist
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from collections import OrderedDict
+import numpy as np
+import threading
+import time
+import utils
+
+"""
+Compositing of the frames of a product. The static layers of the figure
+(background, continents, relief, parallels, coastlines, borders, colorbar...)
+are the same for all the time steps, so they are rendered only once as RGBA
+images. Every frame then only renders the artists of that time step on a
+transparent canvas with the same layout, which are composited with the static
+layers with NumPy. The artists are drawn by matplotlib in order of zorder, so
+the static ones are cut in bands between the artists of the frame (e.g. the
+coastlines between the data and the H/L labels) and the images of the bands
+are composited in the same order.
+Use it in plot_files instead of figure.savefig, passing the artists which are
+removed after saving the frame:
+    layers.savefig(filename, [cs, c, labels, an_fc], key=(variable_name, projection, run))
+Every frame of the same key has to share the same static layers, also when
+drawn on different figures (e.g. a copy for every thread, see render_all.py).
+"""
+
+# Layers kept in memory, the oldest are dropped first
+max_memoised = 8
+memoised = OrderedDict()
+lock = threading.Lock()
+# When recording (see scheduler.time_frames), the CPU time at which every frame
+# is saved by this thread and the seconds it spent rendering static layers
+clock = threading.local()
+
+
+def flatten(elements):
+    """Artists in elements, which can also be lists of artists or contour
+    sets (as passed to utils.remove_collections)."""
+    for element in elements:
+        if element is None:
+            continue
+        if isinstance(element, Artist):
+            yield element
+        elif hasattr(element, 'collections'):
+            # Up to matplotlib 3.7 the contour sets are not artists
+            yield from element.collections
+        else:
+            yield from flatten(element)
+
+
+def split(figure, dynamic):
+    """Artists of the figure, in the order used by matplotlib to draw the
+    children of every axes, in bands of consecutive static or dynamic ones.
+    Returns the static bands and the dynamic ones, which alternate starting
+    from the static band at the bottom (which has at least the figure patch)."""
+    bands = [[figure.patch]]
+    for ax in figure.axes:
+        children = [ax.patch] + sorted((a for a in ax.get_children() if a is not ax.patch),
+                                       key=lambda a: a.get_zorder())
+        for artist in children:
+            is_dynamic = artist in dynamic
+            if not is_dynamic and not artist.get_visible():
+                continue
+            # Even bands are static, odd ones dynamic
+            if is_dynamic == (len(bands) % 2 == 0):
+                bands[-1].append(artist)
+            else:
+                bands.append([artist])
+
+    return bands[::2], bands[1::2]
+
+
+def render(figure, bands, band, box):
+    """RGBA image (float in 0-1) of the box of the figure with only the artists
+    of band among the ones in bands."""
+    shown = set(band)
+    hidden = [artist for artists in bands for artist in artists if artist not in shown]
+    visible = [artist.get_visible() for artist in hidden]
+    for artist in hidden:
+        artist.set_visible(False)
+    try:
+        figure.canvas.draw()
+        image = np.asarray(figure.canvas.buffer_rgba())[box].astype(np.float32) / 255.
+    finally:
+        for artist, v in zip(hidden, visible):
+            artist.set_visible(v)
+
+    return image
+
+
+def get_box(figure, dpi):
+    """Pixels of the canvas in the same box used by savefig(bbox_inches='tight'),
+    which is then kept fixed for all the frames."""
+    renderer = figure.canvas.get_renderer()
+    bbox = figure.get_tightbbox(renderer).padded(matplotlib.rcParams['savefig.pad_inches'])
+    width, height = int(bbox.width * dpi), int(bbox.height * dpi)
+    x0 = max(int(round(bbox.x0 * dpi)), 0)
+    y0 = max(int(round(renderer.height - bbox.y1 * dpi)), 0)
+
+    return slice(y0, y0 + height), slice(x0, x0 + width)
+
+
+def get_layers(figure, static, dynamic, key, dpi):
+    """Images of the static bands and layout of the figure, rendered only the
+    first time. The number of artists in every band is part of the key, so
+    that frames with a different stacking get their own layers."""
+    key = (key, tuple(len(band) for band in static), len(dynamic))
+    with lock:
+        if key in memoised:
+            memoised.move_to_end(key)
+            return memoised[key]
+    start = time.thread_time()
+    box = get_box(figure, dpi)
+    layers = (box, [render(figure, static + dynamic, band, box) for band in static])
+    if getattr(clock, 'frames', None) is not None:
+        clock.setup += time.thread_time() - start
+    with lock:
+        memoised[key] = layers
+        while len(memoised) > max_memoised:
+            memoised.popitem(last=False)
+
+    return layers
+
+
+def composite(*images):
+    """Alpha composite the RGBA images (float in 0-1), the first is at the bottom."""
+    out = images[0].copy()
+    for image in images[1:]:
+        alpha = image[..., 3:]
+        out[..., :3] = image[..., :3] * alpha + out[..., :3] * (1. - alpha)
+        out[..., 3:] = alpha + out[..., 3:] * (1. - alpha)
+
+    return out
+
+
+def savefig(filename, artists, key, figure=None):
+    """Same as figure.savefig(filename, **utils.options_savefig) but only the
+    artists of the frame are rendered, see above. By default the figure is
+    the one of the artists."""
+    figure = figure or next(flatten(artists)).figure
+    if utils.composite_layers:
+        save_composite(filename, artists, key, figure)
+    else:
+        figure.savefig(filename, **utils.options_savefig)
+    if getattr(clock, 'frames', None) is not None:
+        clock.frames.append((time.thread_time(), clock.setup))
+        clock.setup = 0.
+
+
+def save_composite(filename, artists, key, figure):
+    dpi = utils.options_savefig['dpi']
+    # Figures which are not managed by pyplot have no Agg canvas once unpickled
+    if not isinstance(figure.canvas, FigureCanvasAgg):
+        FigureCanvasAgg(figure)
+    # Drawn directly on the canvas, at the resolution of the images
+    figure.set_dpi(dpi)
+    dynamic = list(flatten(artists))
+    static, bands = split(figure, set(dynamic))
+    box, images = get_layers(figure, static, bands, key, dpi)
+    # Static and dynamic bands alternate, from the bottom
+    stack = []
+    for i, image in enumerate(images):
+        stack.append(image)
+        if i < len(bands):
+            stack.append(render(figure, static + bands, bands[i], box))
+    image = composite(*stack)
+
+    mpimg.imsave(filename, np.round(image * 255.).astype(np.uint8), format='png', dpi=dpi)
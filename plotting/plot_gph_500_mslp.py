@@ -1,8 +1,10 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
+import layers
+import raster
+import isolines
+import scheduler
+import derived
 import sys
 
 debug = False
@@ -13,6 +15,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'gph_500_mslp'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['gh', 'prmsl'], level=[50000])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -29,24 +33,36 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['gh', 'prmsl'], level=[50000],
-                              projection=projection)
+    dset, args = prepare(projection)
 
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
-    dset['gh'] = dset['gh'].metpy.convert_units('dam').metpy.dequantify()
+    utils.print_message('Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(0, 2)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
+
+    dset = derived.compute(dset, projection, prmsl='prmsl_hPa', gh='gh_dam')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
     levels_gph = np.arange(470., 600., 10.)
 
     cmap = utils.get_colormap('gph')
     #cmap = truncate_colormap(cmap, 0.05, 0.9)
 
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-
-    ax = plt.gca()
+    ax = utils.create_figure(pyplot=debug).add_subplot()
     # Get coordinates from dataset
-    m, x, y = utils.get_projection(dset, projection, labels=True)
+    m, x, y = utils.get_projection(dset, projection, labels=True, ax=ax)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.load()
 
     if projection == 'nh_polar':
         density = 8
@@ -57,19 +73,11 @@ def main():
                             dset['prmsl'].max().astype("int"), density)
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax, cmap=cmap,
+    args = dict(projection=projection, x=x, y=y, ax=ax, cmap=cmap,
                 levels_gph=levels_gph,
                 levels_mslp=levels_mslp)
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(0, 2)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -80,28 +88,28 @@ def plot_files(dss, **args):
         #data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['gh'],
-                                 extend='both',
-                                 cmap=args['cmap'],
-                                 levels=args['levels_gph'])
+        cs = raster.contourf(args['ax'], args['x'], args['y'],
+                             data['gh'], variable_name, args['projection'],
+                             extend='both',
+                             cmap=args['cmap'],
+                             levels=args['levels_gph'])
 
-        c = args['ax'].contour(args['x'], args['y'],
-                               data['prmsl'],
-                               levels=args['levels_mslp'],
-                               colors='white',
-                               linewidths=1.5)
+        c = isolines.contour(args['ax'], args['x'], args['y'],
+                             data['prmsl'], variable_name, args['projection'], run,
+                             levels=args['levels_mslp'],
+                             colors='white',
+                             linewidths=1.5)
 
         labels = args['ax'].clabel(c, c.levels, inline=True, fmt='%4.0f',
                                    fontsize=6)
 
         maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'max', 120, symbol='H', color='royalblue', random=True)
+                                             'max', 120, symbol='H', color='royalblue')
         minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'min', 120, symbol='L', color='coral', random=True)
+                                             'min', 120, symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'],
@@ -110,16 +118,16 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal',
-                         label='Geopotential height [m]', pad=0.03, fraction=0.04)
+            args['ax'].figure.colorbar(cs, orientation='horizontal',
+                                       label='Geopotential height [m]', pad=0.03, fraction=0.04)
 
+        artists = [c, cs, labels, an_fc, an_var, an_run, maxlabels, minlabels]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections(
-            [c, cs, labels, an_fc, an_var, an_run, maxlabels, minlabels])
+        utils.remove_collections(artists)
 
         first = False
 
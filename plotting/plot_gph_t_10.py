@@ -1,8 +1,11 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
+from matplotlib.artist import setp
 import utils
+import layers
+import raster
+import isolines
+import scheduler
+import derived
 import sys
 from matplotlib import patheffects
 
@@ -14,6 +17,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'gph_t_10'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['t'], level=[1000])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -30,36 +35,41 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['t'], level=[1000],
-                              projection=projection)
+    dset, args = prepare(projection)
 
-    dset['t'] = dset['t'].metpy.convert_units('degC').metpy.dequantify()
+    utils.print_message('Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(0, 2)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
+
+    dset = derived.compute(dset, projection, t='t_degC')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
     levels_temp = np.arange(-100, 24, 4)
 
     cmap = utils.get_colormap('temp_meteociel')
 
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-
-    ax = plt.gca()
+    ax = utils.create_figure(pyplot=debug).add_subplot()
     # Get coordinates from dataset
-    m, x, y = utils.get_projection(dset, projection, labels=True)
+    m, x, y = utils.get_projection(dset, projection, labels=True, ax=ax)
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.load()
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax, cmap=cmap,
+    args = dict(projection=projection, x=x, y=y, ax=ax, cmap=cmap,
                 levels_temp=levels_temp)
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(0, 2)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -70,24 +80,25 @@ def plot_files(dss, **args):
 
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['t'],
-                                 extend='both',
-                                 cmap=args['cmap'],
-                                 levels=args['levels_temp'])
+        cs = raster.contourf(args['ax'], args['x'], args['y'],
+                             data['t'], variable_name, args['projection'],
+                             extend='both',
+                             cmap=args['cmap'],
+                             levels=args['levels_temp'])
 
-        css = args['ax'].contour(args['x'], args['y'],
-                                 data['t'], colors='gray',
-                                 levels=args['levels_temp'][::2],
-                                 linestyles='solid',
-                                 linewidths=0.3)
+        css = isolines.contour(args['ax'], args['x'], args['y'],
+                               data['t'], variable_name, args['projection'], run,
+                               colors='gray',
+                               levels=args['levels_temp'][::2],
+                               linestyles='solid',
+                               linewidths=0.3)
 
         labels2 = args['ax'].clabel(
             css, css.levels, inline=True, fmt='%4.0f', fontsize=7)
-        plt.setp(labels2, path_effects=[
+        setp(labels2, path_effects=[
             patheffects.withStroke(linewidth=0.5, foreground="w")])
 
         an_fc = utils.annotation_forecast(args['ax'], time)
@@ -97,15 +108,16 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal',
-                         label='Temperature [C]', pad=0.03, fraction=0.04)
+            args['ax'].figure.colorbar(cs, orientation='horizontal',
+                                       label='Temperature [C]', pad=0.03, fraction=0.04)
 
+        artists = [cs, css, labels2, an_fc, an_var, an_run]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections([cs, css, labels2, an_fc, an_var, an_run])
+        utils.remove_collections(artists)
 
         first = False
 
@@ -1,12 +1,13 @@
 import seaborn as sns
 from matplotlib.colors import from_levels_and_colors
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
+import layers
+import raster
+import isolines
+import scheduler
+import derived
 import sys
-from computations import compute_snow_change
 
 debug = False
 if not debug:
@@ -16,6 +17,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'hsnow'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['sde', 'gh_2'])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -32,12 +35,25 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['sde', 'gh_2'],
-                              projection=projection)
-    dset['sde'] = dset['sde'].metpy.convert_units('cm').metpy.dequantify()
-    dset['gh_2'] = dset['gh_2'].metpy.convert_units('m').metpy.dequantify()
+    dset, args = prepare(projection)
 
-    dset = compute_snow_change(dset)
+    utils.print_message('Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(-2, -1)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
+    dset = derived.compute(dset, projection, sde='sde_cm', gh_2='gh_2_m',
+                           snow_increment='snow_increment')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
     levels_hsnow = (-50, -40, -30, -20, -10, -5, -2.5, -2, -1, -0.5,
                     0, 0.5, 1, 2, 2.5, 5, 10, 20, 30, 40, 50)
@@ -48,30 +64,20 @@ def main():
                                                           n_colors=len(levels_hsnow) + 1),
                                         extend='both')
 
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-
-    ax = plt.gca()
+    ax = utils.create_figure(pyplot=debug).add_subplot()
     # Get coordinates from dataset
-    m, x, y = utils.get_projection(dset, projection, labels=True)
+    m, x, y = utils.get_projection(dset, projection, labels=True, ax=ax)
     #m.fillcontinents(color='lightgray',lake_color='whitesmoke', zorder=0)
-    m.arcgisimage(service='World_Shaded_Relief', xpixels=1500)
+    utils.draw_relief(m, projection)
 
-    dset = dset.drop(['lon', 'lat', 'sde']).load()
+    dset = dset.drop(['sde']).load()
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(m=m, x=x, y=y, ax=ax, cmap=cmap, norm=norm,
+    args = dict(projection=projection, m=m, x=x, y=y, ax=ax, cmap=cmap, norm=norm,
                 levels_hsnow=levels_hsnow,
                 levels_snowlmt=levels_snowlmt, time=dset.time)
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(-2, -1)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -82,29 +88,29 @@ def plot_files(dss, **args):
         #data['gh_2'].values = mpcalc.smooth_n_point(data['gh_2'].values, n=5, passes=4)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['snow_increment'],
-                                 extend='both',
-                                 cmap=args['cmap'],
-                                 norm=args['norm'],
-                                 levels=args['levels_hsnow'])
+        cs = raster.contourf(args['ax'], args['x'], args['y'],
+                             data['snow_increment'], variable_name, args['projection'],
+                             extend='both',
+                             cmap=args['cmap'],
+                             norm=args['norm'],
+                             levels=args['levels_hsnow'])
 
-        css = args['ax'].contour(args['x'], args['y'],
-                                 data['snow_increment'],
-                                 levels=args['levels_hsnow'],
-                                 colors='gray',
-                                 linewidths=0.2)
+        css = isolines.contour(args['ax'], args['x'], args['y'],
+                               data['snow_increment'], variable_name, args['projection'], run,
+                               levels=args['levels_hsnow'],
+                               colors='gray',
+                               linewidths=0.2)
 
         labels2 = args['ax'].clabel(css, css.levels,
                                     inline=True, fmt='%4.0f', fontsize=6)
 
-        c = args['ax'].contour(args['x'], args['y'],
-                               data['gh_2'],
-                               levels=args['levels_snowlmt'],
-                               colors='red', linewidths=0.5)
+        c = isolines.contour(args['ax'], args['x'], args['y'],
+                             data['gh_2'], variable_name, args['projection'], run,
+                             levels=args['levels_snowlmt'],
+                             colors='red', linewidths=0.5)
 
         labels = args['ax'].clabel(
             c, c.levels, inline=True, fmt='%4.0f', fontsize=5)
@@ -116,16 +122,17 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            cb = plt.colorbar(cs, orientation='horizontal', label='Snow depth change [m]',
-                              pad=0.038, fraction=0.035, ticks=args['levels_hsnow'][::2])
+            cb = args['ax'].figure.colorbar(cs, orientation='horizontal',
+                                            label='Snow depth change [m]', pad=0.038,
+                                            fraction=0.035, ticks=args['levels_hsnow'][::2])
 
+        artists = [c, cs, css, labels, labels2, an_fc, an_var, an_run]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections(
-            [c, cs, css, labels, labels2, an_fc, an_var, an_run])
+        utils.remove_collections(artists)
 
         first = False
 
@@ -1,10 +1,11 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
+import layers
+import raster
+import isolines
+import scheduler
+import derived
 import sys
-from computations import compute_spacing, compute_theta, compute_pv
 
 debug = False
 if not debug:
@@ -14,6 +15,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'pv_250'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['u', 'v', 't', 'prmsl'], level=[15000, 25000, 30000])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -30,9 +33,23 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['u', 'v', 't', 'prmsl'],
-                              level=[15000, 25000, 30000],
-                              projection=projection,)
+    dset, args = prepare(projection)
+
+    utils.print_message(
+        sys.argv[0]+': Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(0, 2)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
 
     if projection != 'world':
         levels_pv = np.linspace(-0.5e-5, 1.6e-5, 30)
@@ -41,36 +58,25 @@ def main():
 
     cmap = utils.get_colormap('temp')
 
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-    ax = plt.gca()
-    m, x, y = utils.get_projection(dset, projection)
-    m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
-    # Subset dataset only on the area
-    dset = compute_spacing(dset)
-    dset = compute_theta(dset)
+    # PV is computed for all time steps here, only once
+    dset = derived.compute(dset, projection, pv='pv', prmsl='prmsl_hPa')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
+    ax = utils.create_figure(pyplot=debug).add_subplot()
+    m, x, y = utils.get_projection(dset, projection, ax=ax)
+    m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
     dset = dset.load()
 
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
     levels_mslp = np.arange(dset['prmsl'].min().astype("int"),
                             dset['prmsl'].max().astype("int"), 5.)
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax,
+    args = dict(projection=projection, x=x, y=y, ax=ax,
                 levels_pv=levels_pv,
                 levels_mslp=levels_mslp,
                 cmap=cmap)
 
-    utils.print_message(
-        sys.argv[0]+': Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(0, 2)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -78,27 +84,27 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data = compute_pv(data)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['pv'].sel(plev=25000),
-                                 extend='max', cmap=args['cmap'],
-                                 levels=args['levels_pv'])
+        cs = raster.contourf(args['ax'], args['x'], args['y'],
+                             data['pv'].sel(plev=25000), variable_name, args['projection'],
+                             extend='max', cmap=args['cmap'],
+                             levels=args['levels_pv'])
 
-        c = args['ax'].contour(args['x'], args['y'], data['prmsl'],
-                               levels=args['levels_mslp'], colors='white', linewidths=1)
+        c = isolines.contour(args['ax'], args['x'], args['y'],
+                             data['prmsl'], variable_name, args['projection'], run,
+                             levels=args['levels_mslp'], colors='white', linewidths=1)
 
         labels = args['ax'].clabel(
             c, c.levels, inline=True, fmt='%4.0f', fontsize=5)
 
         maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'max', 180, symbol='H', color='royalblue', random=True)
+                                             'max', 180, symbol='H', color='royalblue')
         minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'min', 180, symbol='L', color='coral', random=True)
+                                             'min', 180, symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'PV @ 250 hPa and MSLP (hPa)',
@@ -106,16 +112,16 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal',
-                         label='PV [%s]' % data['pv'].units, pad=0.03, fraction=0.035)
+            args['ax'].figure.colorbar(cs, orientation='horizontal',
+                                       label='PV [%s]' % data['pv'].units, pad=0.03, fraction=0.035)
 
+        artists = [cs, c, labels, maxlabels, minlabels, an_fc, an_var, an_run]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections(
-            [cs, c, labels, maxlabels, minlabels, an_fc, an_var, an_run])
+        utils.remove_collections(artists)
 
         first = False
 
@@ -1,8 +1,10 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
+import layers
+import raster
+import isolines
+import scheduler
+import derived
 import sys
 
 debug = False
@@ -13,6 +15,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'precip_acc'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['tp', 'prmsl'])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -29,9 +33,24 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['tp', 'prmsl'],
-                              projection=projection)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset, args = prepare(projection)
+
+    utils.print_message('Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(-2, -1)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
+    dset = derived.compute(dset, projection, prmsl='prmsl_hPa')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
     levels_precip = list(np.arange(1, 50, 0.4)) + \
         list(np.arange(51, 100, 2)) +\
@@ -43,32 +62,23 @@ def main():
     cmap, norm = utils.get_colormap_norm(
         'rain_acc_wxcharts', levels=levels_precip)
 
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
-    ax = plt.gca()
+    ax = utils.create_figure(pyplot=debug).add_subplot()
     # Get coordinates from dataset
-    m, x, y = utils.get_projection(dset, projection, labels=True)
+    m, x, y = utils.get_projection(dset, projection, labels=True, ax=ax)
     # additional maps adjustment for this map
 
-    dset = dset.drop(['lon', 'lat']).load()
+    dset = dset.load()
 
     levels_mslp = np.arange(dset['prmsl'].min().astype("int"),
                             dset['prmsl'].max().astype("int"), 5.)
 
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax,
+    args = dict(projection=projection, x=x, y=y, ax=ax,
                 levels_precip=levels_precip,
                 levels_mslp=levels_mslp, time=dset.time,
                 cmap=cmap, norm=norm)
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(-2, -1)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -77,28 +87,28 @@ def plot_files(dss, **args):
         data = dss.sel(time=time_sel)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].contourf(args['x'], args['y'],
-                                 data['tp'],
-                                 extend='max',
-                                 cmap=args['cmap'],
-                                 norm=args['norm'],
-                                 levels=args['levels_precip'])
+        cs = raster.contourf(args['ax'], args['x'], args['y'],
+                             data['tp'], variable_name, args['projection'],
+                             extend='max',
+                             cmap=args['cmap'],
+                             norm=args['norm'],
+                             levels=args['levels_precip'])
 
-        c = args['ax'].contour(args['x'], args['y'],
-                               data['prmsl'],
-                               levels=args['levels_mslp'], colors='black', linewidths=1.)
+        c = isolines.contour(args['ax'], args['x'], args['y'],
+                             data['prmsl'], variable_name, args['projection'], run,
+                             levels=args['levels_mslp'], colors='black', linewidths=1.)
 
         labels = args['ax'].clabel(
             c, c.levels, inline=True, fmt='%4.0f', fontsize=6)
 
-        if projection != 'nh':
+        if args['projection'] != 'nh':
             maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                                 'max', 150, symbol='H', color='royalblue', random=True)
+                                                 'max', 150, symbol='H', color='royalblue')
             minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                                 'min', 150, symbol='L', color='coral', random=True)
+                                                 'min', 150, symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'Accumulated precipitation and MSLP [hPa]',
@@ -106,16 +116,17 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal', label='Accumulated precipitation [mm]',
-                         pad=0.035, fraction=0.04)
+            args['ax'].figure.colorbar(cs, orientation='horizontal',
+                                       label='Accumulated precipitation [mm]',
+                                       pad=0.035, fraction=0.04)
 
+        artists = [c, cs, labels, an_fc, an_var, an_run, maxlabels, minlabels]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections(
-            [c, cs, labels, an_fc, an_var, an_run, maxlabels, minlabels])
+        utils.remove_collections(artists)
 
         first = False
 
@@ -1,10 +1,11 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
+from matplotlib import colormaps
 import utils
+import layers
+import raster
+import scheduler
+import derived
 import sys
-from computations import compute_rate
 import metpy.calc as mpcalc
 
 debug = False
@@ -15,6 +16,8 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'precip_clouds'
+# Variables and levels read from the dataset (see also write_cutouts.py)
+read_options = dict(variables=['prate', 'csnow', 'crain', 'tcc', 'prmsl'])
 
 utils.print_message('Starting script to plot '+variable_name)
 
@@ -31,11 +34,26 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['prate', 'csnow', 'crain', 'tcc', 'prmsl'],
-                              projection=projection)
+    dset, args = prepare(projection)
 
-    dset = compute_rate(dset)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    utils.print_message('Pre-processing finished, launching plotting scripts')
+    if debug:
+        plot_files(dset.isel(time=slice(0, 2)), **args)
+    else:
+        # Parallelize the plotting on utils.processes workers, in batches of
+        # time steps of about the same cost (see scheduler.py)
+        scheduler.map(plot_files, dset, args, utils.processes, variable_name)
+
+
+def prepare(projection, dset=None):
+    """Read the variables, create the figure with the projection and collect
+    all the arguments that need to be passed to plot_files. An already opened
+    dataset (see utils.open_dataset) can be passed to avoid reading it again."""
+    dset = utils.read_dataset(**read_options, projection=projection, dset=dset)
+
+    dset = derived.compute(dset, projection, rain_rate='rain_rate', snow_rate='snow_rate',
+                           prmsl='prmsl_hPa')
+    dset = utils.coarsen_dataset(dset, projection, variable_name)
 
     levels_rain = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                    5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
@@ -45,13 +63,11 @@ def main():
 
     cmap_snow, norm_snow = utils.get_colormap_norm("snow", levels_snow)
     cmap_rain, norm_rain = utils.get_colormap_norm("rain_new", levels_rain)
-    cmap_clouds = utils.truncate_colormap(plt.get_cmap('Greys'), 0.1, 0.6)
-
-    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
+    cmap_clouds = utils.truncate_colormap(colormaps['Greys'], 0.1, 0.6)
 
-    ax = plt.gca()
+    ax = utils.create_figure(pyplot=debug).add_subplot()
     # Get coordinates from dataset
-    m, x, y = utils.get_projection(dset, projection, labels=True)
+    m, x, y = utils.get_projection(dset, projection, labels=True, ax=ax)
     m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
 
     dset = dset.drop(['lon', 'lat', 'prate', 'csnow', 'crain']).load()
@@ -59,22 +75,14 @@ def main():
     levels_mslp = np.arange(dset['prmsl'].min().astype("int"),
                             dset['prmsl'].max().astype("int"), 5.)
 
-    args = dict(x=x, y=y, ax=ax,
+    args = dict(projection=projection, x=x, y=y, ax=ax,
                 levels_mslp=levels_mslp, levels_rain=levels_rain,
                 levels_snow=levels_snow,
                 levels_clouds=levels_clouds,
                 cmap_rain=cmap_rain, cmap_snow=cmap_snow, cmap_clouds=cmap_clouds,
                 norm_snow=norm_snow, norm_rain=norm_rain)
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
-    if debug:
-        plot_files(dset.isel(time=slice(0, 2)), **args)
-    else:
-        # Parallelize the plotting by dividing into chunks and utils.processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+    return dset, args
 
 
 def plot_files(dss, **args):
@@ -85,18 +93,21 @@ def plot_files(dss, **args):
             data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs_rain = args['ax'].contourf(args['x'], args['y'], data['rain_rate'],
-                                      extend='max', cmap=args['cmap_rain'], norm=args['norm_rain'],
-                                      levels=args['levels_rain'], zorder=4, antialiased=True)
-        cs_snow = args['ax'].contourf(args['x'], args['y'], data['snow_rate'],
-                                      extend='max', cmap=args['cmap_snow'], norm=args['norm_snow'],
-                                      levels=args['levels_snow'], zorder=5)
-        cs_clouds_low = args['ax'].contourf(args['x'], args['y'], data['tcc'],
-                                            extend='max', cmap=args['cmap_clouds'],
-                                            levels=args['levels_clouds'], zorder=3)
+        cs_rain = raster.contourf(args['ax'], args['x'], args['y'], data['rain_rate'],
+                                  variable_name, args['projection'],
+                                  extend='max', cmap=args['cmap_rain'], norm=args['norm_rain'],
+                                  levels=args['levels_rain'], zorder=4, antialiased=True)
+        cs_snow = raster.contourf(args['ax'], args['x'], args['y'], data['snow_rate'],
+                                  variable_name, args['projection'],
+                                  extend='max', cmap=args['cmap_snow'], norm=args['norm_snow'],
+                                  levels=args['levels_snow'], zorder=5)
+        cs_clouds_low = raster.contourf(args['ax'], args['x'], args['y'], data['tcc'],
+                                        variable_name, args['projection'],
+                                        extend='max', cmap=args['cmap_clouds'],
+                                        levels=args['levels_clouds'], zorder=3)
 
         c = args['ax'].contour(args['x'], args['y'], data['prmsl'],
                                levels=args['levels_mslp'], colors='whitesmoke', linewidths=1., zorder=7, alpha=1.0)
@@ -105,9 +116,9 @@ def plot_files(dss, **args):
             c, c.levels, inline=True, fmt='%4.0f', fontsize=6)
 
         maxlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'max', 180, symbol='H', color='royalblue', random=True)
+                                             'max', 180, symbol='H', color='royalblue')
         minlabels = utils.plot_maxmin_points(args['ax'], args['x'], args['y'], data['prmsl'],
-                                             'min', 180, symbol='L', color='coral', random=True)
+                                             'min', 180, symbol='L', color='coral')
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'Clouds (grey-low), rain, snow and MSLP',
@@ -116,20 +127,21 @@ def plot_files(dss, **args):
 
         if first:
             ax_cbar, ax_cbar_2 = utils.divide_axis_for_cbar(args['ax'])
-            cbar_snow = plt.gcf().colorbar(cs_snow, cax=ax_cbar, orientation='horizontal',
-                                           label='Snow [cm/hr]')
-            cbar_rain = plt.gcf().colorbar(cs_rain, cax=ax_cbar_2, orientation='horizontal',
-                                           label='Rain [mm/hr]')
+            cbar_snow = args['ax'].figure.colorbar(cs_snow, cax=ax_cbar, orientation='horizontal',
+                                                   label='Snow [cm/hr]')
+            cbar_rain = args['ax'].figure.colorbar(cs_rain, cax=ax_cbar_2, orientation='horizontal',
+                                                   label='Rain [mm/hr]')
             cbar_snow.ax.tick_params(labelsize=8)
             cbar_rain.ax.tick_params(labelsize=8)
 
+        artists = [c, cs_rain, cs_snow, cs_clouds_low, labels, an_fc, an_var, an_run, maxlabels,
+                   minlabels]
         if debug:
-            plt.show(block=True)
+            utils.show()
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            layers.savefig(filename, artists, key=(variable_name, args['projection'], run))
 
-        utils.remove_collections([c, cs_rain, cs_snow, cs_clouds_low,
-                                  labels, an_fc, an_var, an_run, maxlabels, minlabels])
+        utils.remove_collections(artists)
 
         first = False
 
@@ -0,0 +1,160 @@
+from scipy.spatial import Delaunay
+import matplotlib.cm as mplcm
+from matplotlib.colors import from_levels_and_colors
+from collections import OrderedDict
+import numpy as np
+import threading
+import hashlib
+import utils
+import os
+
+"""
+Filled contours drawn as an image. With many levels (e.g. the accumulated
+precipitation) contourf builds huge path collections which are slow to
+create and to rasterise. Here instead the field is interpolated (linearly,
+on the triangles of the projected grid) on the pixels of the axes, every
+pixel is assigned to its band of levels with np.digitize and the bands are
+drawn with imshow in the same colors contourf would use. Line contours
+and labels are still drawn as vectors. Use
+    cs = raster.contourf(ax, x, y, data, variable_name, projection,
+                         levels=levels, cmap=cmap, norm=norm, extend='max')
+which is the same as ax.contourf(x, y, data, ...) unless the product is
+listed for the projection in utils.raster_products. The interpolation weights
+only depend on the grid and on the axes, so they are computed once and
+saved in the cache folder.
+"""
+
+# Interpolation weights kept in memory, the oldest are dropped first
+max_memoised = 8
+memoised = OrderedDict()
+lock = threading.Lock()
+
+
+def enabled(product, projection):
+    return projection in utils.raster_products.get(product, [])
+
+
+def contourf(ax, x, y, data, product, projection, **kwargs):
+    """Same as ax.contourf(x, y, data, **kwargs), as an image if enabled
+    for the product and projection (see above)."""
+    if not enabled(product, projection):
+        return ax.contourf(x, y, data, **kwargs)
+
+    levels = np.asarray(kwargs.pop('levels'), dtype=np.float64)
+    extend = kwargs.pop('extend', 'neither')
+    colors = get_colors(levels, extend, kwargs.pop('cmap', None), kwargs.pop('norm', None))
+    kwargs.pop('antialiased', None)
+    x0, x1 = ax.get_xlim()
+    y0, y1 = ax.get_ylim()
+    shape = get_shape(ax)
+    indices, weights = get_weights(x, y, (x0, x1, y0, y1), shape)
+    bands = digitize(np.asarray(data, dtype=np.float32).ravel(), indices, weights, levels)
+    table = np.round(colors * 255).astype(np.uint8)
+    if extend not in ('both', 'min'):
+        table[0] = 0
+    if extend not in ('both', 'max'):
+        table[-2] = 0
+
+    image = ax.imshow(table[bands].reshape(shape + (4,)), origin='lower',
+                      extent=(x0, x1, y0, y1), aspect=ax.get_aspect(),
+                      interpolation='nearest', zorder=kwargs.pop('zorder', 1), **kwargs)
+    # The colors are already computed, these are only used by the colorbar
+    first = 0 if extend in ('both', 'min') else 1
+    last = len(levels) + 1 if extend in ('both', 'max') else len(levels)
+    image.cmap, image.norm = from_levels_and_colors(levels, colors[first:last], extend=extend)
+
+    return image
+
+
+def get_colors(levels, extend, cmap=None, norm=None):
+    """RGBA colors (float in 0-1) of the bands under the first level, between
+    the levels and over the last one, as given by contourf (which normalizes
+    the value in the middle of every band and, when extended, a value outside
+    the levels for the colors under/over), plus a transparent one."""
+    bounds = np.concatenate([[-1e250], levels, [1e250]])
+    mappable = mplcm.ScalarMappable(norm=norm, cmap=cmap)
+    mappable.norm.autoscale_None(levels)
+    if extend != 'neither':
+        mappable.norm.clip = False
+    colors = mappable.to_rgba(0.5 * (bounds[:-1] + bounds[1:]))
+
+    return np.concatenate([colors, [[0., 0., 0., 0.]]])
+
+
+def digitize(values, indices, weights, levels):
+    """Band of levels of the values interpolated on the pixels (0 under the
+    first level, len(levels) over the last one and len(levels) + 1 for NaN).
+    As in contourf, every band includes its upper level and the first one
+    also the lowest level."""
+    values = np.einsum('ij,ij->i', values[indices], weights)
+    bands = np.digitize(values, levels, right=True)
+    bands[values == levels[0]] = 1
+    bands[np.isnan(values)] = len(levels) + 1
+
+    return bands
+
+
+def get_shape(ax):
+    """Pixels (rows, columns) of the axes in the saved images."""
+    ax.apply_aspect()
+    position = ax.get_position()
+    width, height = ax.figure.get_size_inches() * utils.options_savefig['dpi']
+
+    return int(round(position.height * height)), int(round(position.width * width))
+
+
+def get_key(x, y, extent, shape):
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    definition = repr((x.shape, extent, shape)).encode() + x.tobytes() + y.tobytes()
+
+    return hashlib.md5(definition).hexdigest()[:12]
+
+
+def get_filename(key, name):
+    return utils.cache_folder + 'raster_%s_%s.npy' % (key, name)
+
+
+def get_weights(x, y, extent, shape):
+    """Indices of the grid points around every pixel and their weights."""
+    key = get_key(x, y, extent, shape)
+    with lock:
+        weights = memoised.get(key)
+    if weights is None:
+        filenames = [get_filename(key, name) for name in ('indices', 'weights')]
+        if all(os.path.isfile(filename) for filename in filenames):
+            weights = tuple(np.load(filename) for filename in filenames)
+        else:
+            weights = compute_weights(x, y, extent, shape)
+            for filename, array in zip(filenames, weights):
+                utils.write_cache(filename, array)
+    with lock:
+        memoised[key] = weights
+        memoised.move_to_end(key)
+        while len(memoised) > max_memoised:
+            memoised.popitem(last=False)
+
+    return weights
+
+
+def compute_weights(x, y, extent, shape):
+    """Barycentric weights of the centers of the pixels in the triangles of
+    the projected grid. Pixels outside of the grid get no weight."""
+    x0, x1, y0, y1 = extent
+    rows, columns = shape
+    px, py = np.meshgrid(x0 + (np.arange(columns) + 0.5) * (x1 - x0) / columns,
+                         y0 + (np.arange(rows) + 0.5) * (y1 - y0) / rows)
+    pixels = np.column_stack([px.ravel(), py.ravel()])
+    points = np.column_stack([np.ravel(x), np.ravel(y)])
+    # Points outside of the map (e.g. projected to infinity) are not used
+    valid = np.flatnonzero(np.isfinite(points).all(axis=1))
+    triangulation = Delaunay(points[valid])
+    simplex = triangulation.find_simplex(pixels)
+    transform = triangulation.transform[simplex]
+    partial = np.einsum('ijk,ik->ij', transform[:, :2], pixels - transform[:, 2])
+    weights = np.column_stack([partial, 1. - partial.sum(axis=1)]).astype(np.float32)
+    indices = valid[triangulation.simplices[simplex]].astype(np.int32)
+    # The weights of the pixels outside are NaN, so that they are not drawn
+    weights[simplex < 0] = np.nan
+
+    return indices, weights
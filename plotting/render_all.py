@@ -0,0 +1,242 @@
+import argparse
+import importlib
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pickle
+import utils
+import shared
+import scheduler
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+
+import matplotlib
+matplotlib.use('Agg')
+
+"""
+Render all products for all projections from a single process.
+The dataset is opened only once and every (product, projection, time chunk)
+is scheduled on the same pool of workers, instead of starting a new
+interpreter (and a new pool) for every script/projection pair. The data of
+every product is handed to the workers through shared memory (see shared.py)
+and its time steps are grouped in batches by their cost (see scheduler.py).
+Every product module has to expose prepare() and plot_files().
+With --threads the batches are plotted instead by threads of this process,
+which all read the same data and draw each on its own copy of the figure
+(no pyplot is used, see utils.create_figure): the time spent by Agg to
+draw and by the PNG encoder releases the GIL, and the memory of a worker
+process for every batch is saved.
+With --stream the names of the GRIB files are read from stdin
+(downloader.py --stream) and every forecast step is converted and
+plotted as soon as it is downloaded.
+"""
+
+products = ["plot_gph_500_mslp", "plot_gph_t_50", "plot_gph_t_10", "plot_gph_t_850",
+            "plot_rain_acc", "plot_pv_250", "plot_rain_clouds", "plot_hsnow"]
+
+projections = ["euratl", "it", "de", "nh_polar"]
+
+# These products need the whole run (e.g. the change since the first step)
+# so they cannot be plotted one step at a time
+not_streamable = ["plot_hsnow"]
+
+# How many products can be prepared in advance while the workers are still
+# busy with the previous ones: every one of them keeps its data in memory
+max_pending = 2
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-s', '--products', help='Products (plotting scripts) to render',
+                    default=products,
+                    nargs='+')
+parser.add_argument('-p', '--projections', help='Projections',
+                    default=projections,
+                    choices=list(utils.proj_defs.keys()),
+                    nargs='+')
+parser.add_argument('-j', '--processes', help='Number of plotting workers',
+                    default=utils.processes, type=int)
+parser.add_argument('-t', '--threads', help='Number of plotting threads in this process, '
+                    'used instead of the worker processes', default=0, type=int)
+parser.add_argument('--stream', help='Plot every forecast step as soon as its GRIB file '
+                    'name is read from stdin', action='store_true')
+
+
+def main():
+    args = parser.parse_args()
+    if args.stream:
+        return stream(args)
+    # Open the dataset (or the cutout, see write_cutouts.py) of every projection
+    # only once, every product takes its own subset from it
+    datasets = {projection: utils.open_dataset(projection=projection)
+                for projection in args.projections}
+
+    modules = [importlib.import_module(product.replace('.py', ''))
+               for product in args.products]
+
+    if args.threads:
+        pool, workers = ThreadPool(args.threads), args.threads
+    else:
+        pool, workers = shared.get_pool(args.processes), args.processes
+    pending = []
+    for module in modules:
+        for projection in args.projections:
+            pending.append(schedule(pool, workers, module, projection,
+                                    datasets[projection], threads=args.threads > 0))
+            while len(pending) > max_pending:
+                wait(*pending.pop(0))
+
+    for product in pending:
+        wait(*product)
+
+    pool.close()
+    pool.join()
+
+
+def schedule(pool, workers, module, projection, dset, threads=False):
+    """Prepare a product for a projection in the main process and submit
+    all its batches of time steps to the pool (of processes or threads)."""
+    name = module.__name__
+    try:
+        dset, args = module.prepare(projection, dset=dset)
+    except Exception as e:
+        utils.print_message('WARNING: could not prepare %s for %s (%s)' %
+                            (name, projection, e))
+        return name, projection, None, []
+
+    hours = scheduler.get_hours(dset)
+    costs = scheduler.estimate(module.variable_name, projection, hours)
+    batches = scheduler.get_batches(costs, workers)
+    if threads:
+        # The threads share the data and the arrays, everything else (the
+        # figure) is copied for every batch
+        handle = None
+        frozen = pickle.dumps({key: value for key, value in args.items()
+                               if not isinstance(value, np.ndarray)})
+        tasks = [pool.apply_async(render_batch, (name, dset, args, frozen, batch))
+                 for batch in batches]
+    else:
+        # The workers only receive the names of the shared blocks and the time steps
+        # (plot_files is pickled by reference), the same as scheduler.map
+        handle = shared.share(dset, args)
+        tasks = [pool.apply_async(scheduler.run, (module.plot_files, handle, batch))
+                 for batch in batches]
+    utils.print_message('Scheduled %d batches of %s for %s' %
+                        (len(tasks), name, projection))
+
+    return name, projection, handle, tasks
+
+
+def wait(name, projection, handle, tasks):
+    """Wait until all batches of a product are plotted, release its shared
+    memory and save the time taken by every step."""
+    timings = {}
+    for task in tasks:
+        try:
+            timings.update(task.get())
+        except Exception as e:
+            utils.print_message('WARNING: could not plot %s for %s (%s)' %
+                                (name, projection, e))
+    scheduler.update_costs(importlib.import_module(name).variable_name, projection, timings)
+    if handle is not None:
+        handle.release()
+
+
+def stream(args):
+    """Consume the GRIB files as they are downloaded: every file is converted
+    on its own by a worker and, once done, all products for all projections are
+    plotted for that step while the next ones are still being downloaded."""
+    names = [product.replace('.py', '') for product in args.products]
+    for name in names:
+        if name in not_streamable:
+            utils.print_message('WARNING: %s cannot be streamed, skipping' % name)
+    names = [name for name in names if name not in not_streamable]
+
+    # The workers have to be forked before reading from stdin, otherwise
+    # they inherit the lock held by the reader and hang when closing stdin
+    pool = Pool(args.processes)
+    events = queue.Queue()
+    threading.Thread(target=read_files, args=(events,), daemon=True).start()
+
+    tasks = []
+    converting = 0
+    finished = False
+    while not finished or converting > 0:
+        event, value = events.get()
+        if event == 'grib':
+            converting += 1
+            pool.apply_async(convert_step, (value,),
+                             callback=lambda step: events.put(('step', step)),
+                             error_callback=lambda e: events.put(('error', e)))
+        elif event == 'step':
+            converting -= 1
+            for name in names:
+                for projection in args.projections:
+                    tasks.append((name, projection,
+                                  pool.apply_async(render_step, (name, projection, value))))
+        elif event == 'error':
+            converting -= 1
+            utils.print_message('WARNING: could not convert file (%s)' % value)
+        elif event == 'eof':
+            finished = True
+
+    for name, projection, task in tasks:
+        try:
+            task.get()
+        except Exception as e:
+            utils.print_message('WARNING: could not plot %s for %s (%s)' %
+                                (name, projection, e))
+
+    pool.close()
+    pool.join()
+
+
+def read_files(events):
+    """Push every file name read from stdin on the queue of events.
+    Everything else printed by the downloader is passed through."""
+    for line in sys.stdin:
+        line = line.strip()
+        if os.path.isfile(line):
+            events.put(('grib', line))
+        elif line:
+            print(line, flush=True)
+    events.put(('eof', None))
+
+
+def convert_step(filename):
+    """Convert a single GRIB file to NetCDF shifting the grid from 0,360 to
+    -180,180, the same that is done by cdo on the merged file."""
+    if os.path.getsize(filename) == 0:
+        raise ValueError('%s is empty' % filename)
+    subprocess.run(['cdo', '-s', '-f', 'nc', 'copy', '-sellonlatbox,-180,180,-90,90',
+                    filename, filename + '.nc'], check=True)
+
+    return filename + '.nc'
+
+
+def render_step(name, projection, filename):
+    """Executed in the workers: plot a single forecast step of a product."""
+    module = importlib.import_module(name)
+    dset, args = module.prepare(projection, dset=utils.open_dataset(filename))
+    module.plot_files(dset, **args)
+
+
+def render_batch(name, dset, args, frozen, batch):
+    """Executed in the threads: plot a batch of time steps of a product on
+    a copy of its figure (the arguments without arrays, pickled in frozen).
+    Returns the time taken by every forecast hour (see scheduler.time_frames)."""
+    module = importlib.import_module(name)
+
+    return scheduler.time_frames(module.plot_files, dset.isel(time=batch),
+                                 {**args, **pickle.loads(frozen)})
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -0,0 +1,148 @@
+import numpy as np
+import shared
+import layers
+import utils
+import json
+import time
+import os
+
+"""
+Scheduling of the time steps of a product on the plotting workers. Instead
+of cutting the run in fixed chunks of utils.chunks_size steps, the steps are
+grouped in batches of consecutive steps by their cost, using the time that
+every step (forecast hour) of every product and projection took in the
+previous runs. The most expensive batches are submitted first to the pool,
+whose workers take the next one as soon as they are free, and the batches
+get smaller towards the end, so that no worker is left with a long chunk
+while the others are idle. The time taken by every frame is measured when
+plotting (see time_frames), saved in the cache folder and used by the next runs.
+"""
+
+costs_filename = utils.cache_folder + 'frame_costs.json'
+# Every batch costs about 1/batches_per_worker of what is left for every
+# worker, so the batches get smaller towards the end and the load can be
+# balanced when the last ones are plotted
+batches_per_worker = 2
+# Weight of the last run in the estimated cost of a step
+smoothing = 0.5
+
+
+def read_costs():
+    if not os.path.isfile(costs_filename):
+        return {}
+    try:
+        with open(costs_filename) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def update_costs(product, projection, timings):
+    """Merge the seconds taken by every forecast hour ({hour: seconds})
+    into the saved costs."""
+    if not timings:
+        return
+    costs = read_costs()
+    known = costs.setdefault('%s/%s' % (product, projection), {})
+    for hour, seconds in timings.items():
+        hour = str(hour)
+        known[hour] = seconds if hour not in known else \
+            smoothing * seconds + (1 - smoothing) * known[hour]
+    os.makedirs(utils.cache_folder, exist_ok=True)
+    tmp_filename = costs_filename + '.%d.tmp' % os.getpid()
+    with open(tmp_filename, 'w') as f:
+        json.dump(costs, f, indent=1, sort_keys=True)
+    os.replace(tmp_filename, costs_filename)
+
+
+def get_hours(dset):
+    return utils.get_time_run_cum(dset)[2].tolist()
+
+
+def estimate(product, projection, hours, costs=None):
+    """Cost of every forecast hour, from the previous runs of the same
+    product and projection. Unknown hours get the mean cost of the known
+    ones, or 1 if the product was never plotted."""
+    costs = read_costs() if costs is None else costs
+    known = costs.get('%s/%s' % (product, projection), {})
+    default = np.mean(list(known.values())) if known else 1.
+
+    return np.array([known.get(str(hour), default) for hour in hours])
+
+
+def get_batches(costs, processes, max_size=utils.chunks_size):
+    """Group the steps (indices of costs) in batches of at most max_size
+    consecutive steps, every batch being smaller than the previous ones as the
+    remaining work decreases. The batches are slices, so that the time steps
+    of a batch are a view of the (shared) data instead of a copy, sorted from
+    the most expensive."""
+    remaining = costs.sum()
+    batches, start, total = [], 0, 0.
+    for i, cost in enumerate(costs):
+        total += cost
+        if total >= remaining / (processes * batches_per_worker) or i + 1 - start == max_size:
+            batches.append(slice(start, i + 1))
+            remaining -= total
+            start, total = i + 1, 0.
+    if start < len(costs):
+        batches.append(slice(start, len(costs)))
+
+    return sorted(batches, key=lambda batch: -costs[batch].sum())
+
+
+def run(function, handle, batch):
+    """Executed in the workers: plot a batch of steps and return the time
+    taken by every forecast hour."""
+    try:
+        dss, args = shared.get(handle, batch)
+        return time_frames(function, dss, args)
+    finally:
+        dss = args = None
+        shared.detach()
+
+
+def time_frames(function, dss, args):
+    """Plot the steps of dss with function(dss, **args) and return the seconds
+    taken by every forecast hour ({hour: seconds}): the CPU time of the thread
+    between the frames saved with layers.savefig (so that it does not depend on
+    how many workers share the CPUs), without the time spent rendering the
+    static layers. The overhead of the batch (reading the data, creating the
+    figure...) is not part of any step. Nothing is returned if not all the
+    frames were saved."""
+    hours = get_hours(dss)
+    layers.clock.frames, layers.clock.setup = [], 0.
+    start = time.thread_time()
+    try:
+        function(dss, **args)
+        frames = layers.clock.frames
+    finally:
+        layers.clock.frames = None
+    if len(frames) != len(hours):
+        return {}
+    ends = [start] + [end for end, _ in frames]
+
+    return {hour: ends[i + 1] - ends[i] - setup for i, (hour, (_, setup))
+            in enumerate(zip(hours, frames))}
+
+
+def map(function, dset, args, processes, product):
+    """Plot all the steps of dset with function(dss, **args) on a pool of
+    processes workers, the data being shared (see shared.py)."""
+    hours = get_hours(dset)
+    costs = estimate(product, args['projection'], hours)
+    batches = get_batches(costs, processes)
+    handle = shared.share(dset, args)
+    pool = shared.get_pool(processes)
+    timings = {}
+    try:
+        tasks = [pool.apply_async(run, (function, handle, batch)) for batch in batches]
+        for task in tasks:
+            timings.update(task.get())
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        handle.release()
+    update_costs(product, args['projection'], timings)
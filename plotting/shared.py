@@ -0,0 +1,140 @@
+from multiprocessing import shared_memory, resource_tracker, Pool
+import numpy as np
+import xarray as xr
+import pickle
+
+"""
+Hand-off of the data of a product to the plotting workers through shared
+memory. The loaded variables and the arrays passed to plot_files (e.g. the
+projected x, y coordinates) are copied into shared memory blocks only once,
+the remaining arguments (figure, colormaps, levels...) are pickled once in
+another block. The workers only receive the names of the blocks and the
+time steps to plot, and map the same memory instead of receiving (and
+keeping) their own copy of every chunk. Use
+    handle = shared.share(dset, args)
+    # in the workers
+    dss, args = shared.get(handle, slice(0, 3))
+    # when all the time steps are plotted
+    handle.release()
+which is what scheduler.map does for the scripts.
+"""
+
+# Blocks mapped by this process for the current task, and the ones which
+# could not be unmapped yet as their arrays are still used
+attached = {}
+pending = []
+
+
+def attach(name):
+    """Shared memory block (opened only once for every task)."""
+    if name not in attached:
+        attached[name] = shared_memory.SharedMemory(name=name)
+
+    return attached[name]
+
+
+def detach():
+    """Unmap the blocks at the end of a task, so that the memory is freed
+    as soon as the product is done and the blocks are removed."""
+    blocks = pending + list(attached.values())
+    attached.clear()
+    pending.clear()
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            pending.append(block)
+
+
+def attach_array(name, shape, dtype):
+    return np.ndarray(shape, dtype=dtype, buffer=attach(name).buf)
+
+
+class SharedArray:
+    """Copy of an array in shared memory. When pickled only the name of the
+    block is sent, and it is unpickled as an array using the same memory."""
+
+    def __init__(self, array):
+        array = np.asarray(array, order='C')
+        self.shape, self.dtype = array.shape, array.dtype
+        self.block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self.block.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.block.buf)[...] = array
+
+    def __reduce__(self):
+        return attach_array, (self.name, self.shape, self.dtype)
+
+    def get(self):
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self.block.buf)
+
+    def release(self):
+        self.block.close()
+        self.block.unlink()
+
+
+class SharedProduct:
+    """The data of a product (dataset and arguments of plot_files) in
+    shared memory. Only the names of the blocks are pickled."""
+
+    def __init__(self, dset, args):
+        self.arrays = []
+        self.variables = {var: (dset[var].dims, self.share(dset[var].values), dset[var].attrs)
+                          for var in dset.data_vars}
+        self.coords = {name: coord.variable for name, coord in dset.coords.items()}
+        self.attrs = dset.attrs
+        args = {key: self.share(value) if isinstance(value, np.ndarray) else value
+                for key, value in args.items()}
+        self.args = self.share(np.frombuffer(pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL),
+                                             dtype=np.uint8))
+
+    def share(self, array):
+        if array.dtype.hasobject:
+            # Only plain arrays can be shared, these are pickled
+            return array
+        array = SharedArray(array)
+        self.arrays.append(array)
+
+        return array
+
+    def __getstate__(self):
+        return {'variables': self.variables, 'coords': self.coords,
+                'attrs': self.attrs, 'args': self.args}
+
+    def release(self):
+        """Free the memory, to be called once all workers are done."""
+        for array in self.arrays:
+            array.release()
+        self.arrays = []
+
+
+def share(dset, args):
+    return SharedProduct(dset, args)
+
+
+def resolve(array):
+    """Arrays are already unpickled in the workers, not in the process
+    which shared them."""
+    return array.get() if isinstance(array, SharedArray) else array
+
+
+def get(handle, batch):
+    """Dataset with the time steps of batch and arguments of plot_files
+    (unpickled every time, so that every chunk gets its own figure). The
+    batch should be a slice, so that the dataset uses the shared memory
+    instead of a copy of the time steps."""
+    dset = xr.Dataset({var: (dims, resolve(values), attrs)
+                       for var, (dims, values, attrs) in handle.variables.items()},
+                      coords=handle.coords, attrs=handle.attrs)
+    args = pickle.loads(resolve(handle.args))
+
+    return dset.isel(time=batch), args
+
+
+def get_pool(processes):
+    """Pool of workers which can map the shared blocks. The resource tracker
+    is started before forking so that all processes use the same one,
+    otherwise every worker would try to remove the blocks when exiting."""
+    resource_tracker.ensure_running()
+
+    return Pool(processes)
+
@@ -0,0 +1,78 @@
+from matplotlib.artist import Artist
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.patheffects as path_effects
+from functools import lru_cache
+import numpy as np
+
+"""
+Many texts drawn by a single artist. Every distinct text (e.g. the H/L
+symbols or the digits of a value) is rendered only once as a small RGBA
+image, a sprite, which is then stamped at all the points where it is used,
+instead of creating, laying out and rendering one Text artist per point.
+When every point has its own color the sprites are rendered in white and
+tinted, so that they are still rendered only once.
+"""
+
+
+@lru_cache(maxsize=512)
+def get_sprite(text, dpi, color, size, weight, ha, va, stroke):
+    """Image (RGBA) of a text and the position of its anchor in the image,
+    rendered only once for every text and style."""
+    figure = Figure(figsize=(4, 4), dpi=dpi, facecolor='none')
+    canvas = FigureCanvasAgg(figure)
+    options = dict(color=color, size=size, fontweight=weight, ha=ha, va=va)
+    if stroke:
+        options['path_effects'] = [path_effects.withStroke(linewidth=1, foreground=stroke)]
+    label = figure.text(0.5, 0.5, text, **options)
+    canvas.draw()
+    extent = label.get_window_extent().padded(2)
+    height = canvas.get_renderer().height
+    x0, x1 = max(int(np.floor(extent.x0)), 0), int(np.ceil(extent.x1))
+    y0, y1 = max(int(np.floor(height - extent.y1)), 0), int(np.ceil(height - extent.y0))
+    image = np.array(canvas.buffer_rgba())[y0:y1, x0:x1]
+    # Position of the text from the lower left corner of the image
+    anchor = (figure.bbox.width / 2 - x0, y1 - height / 2)
+
+    return image, anchor
+
+
+def tint(image, color):
+    """Sprite rendered in white in the given color (RGBA, uint8)."""
+    return (image * (color / 255.)).astype(np.uint8)
+
+
+class Labels(Artist):
+    """Texts with the same style at many points, in data coordinates of ax,
+    drawn as images (see get_sprite). colors can also be an array with the
+    RGBA color (float in 0-1) of every point."""
+
+    def __init__(self, ax, x, y, texts, color='k', size=10, weight='normal', ha='center',
+                 va='center', stroke=None, zorder=8):
+        super().__init__()
+        self.axes = ax
+        self.set_figure(ax.figure)
+        self.set_transform(ax.transData)
+        self.set_clip_box(ax.bbox)
+        self.set_zorder(zorder)
+        self.set_in_layout(False)
+        self.x, self.y, self.texts = np.asarray(x), np.asarray(y), list(texts)
+        self.colors = None
+        if not isinstance(color, str) and np.ndim(color) == 2:
+            self.colors = np.round(np.asarray(color) * 255.)
+            color = 'white'
+        self.style = (color, size, weight, ha, va, stroke)
+
+    def draw(self, renderer):
+        if not self.get_visible() or not self.texts:
+            return
+        gc = renderer.new_gc()
+        self._set_gc_clip(gc)
+        points = self.get_transform().transform(np.column_stack([self.x, self.y]))
+        for i, ((px, py), text) in enumerate(zip(points, self.texts)):
+            image, (ax_, ay) = get_sprite(text, renderer.dpi, *self.style)
+            if self.colors is not None:
+                image = tint(image, self.colors[i])
+            renderer.draw_image(gc, int(round(px - ax_)), int(round(py - ay)), image[::-1])
+        gc.restore()
+        self.stale = False
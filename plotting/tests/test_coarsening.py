@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils  # noqa: E402
+import hilo  # noqa: E402
+
+"""
+The fields are averaged in blocks of grid points when the grid is finer
+than the pixels of the images, and the size of the blocks is used by
+plot_maxmin_points to look for the extrema in the same area.
+"""
+
+
+def get_dataset():
+    """Two steps of a 0.25 degrees grid over euratl, with the run."""
+    lat = np.arange(29.5, 70.75, 0.25)
+    lon = np.arange(-23.5, 45.25, 0.25)
+    time = pd.date_range('2022-08-26 09:00', periods=2, freq='3h')
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    field = lon2d + 10 * lat2d + np.arange(2)[:, None, None]
+    dset = xr.Dataset({'prmsl': (('time', 'lat', 'lon'), field)},
+                      coords={'time': time, 'lat': lat, 'lon': lon})
+    dset['run'] = pd.Timestamp('2022-08-26 06:00')
+
+    return dset
+
+
+def test_coarsen_dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'cache_folder', str(tmp_path) + '/')
+    monkeypatch.setattr(utils, 'coarsenings', {})
+    # Many points per pixel, so that the grid is averaged
+    monkeypatch.setattr(utils, 'points_per_pixel', 0.05)
+    dset = get_dataset()
+    factor = utils.get_coarsening(dset, 'euratl')
+    assert factor > 1
+    # The second time it is read from the cache
+    monkeypatch.setattr(utils, 'coarsenings', {})
+    monkeypatch.setattr(utils, 'compute_coarsening', None)
+    assert utils.get_coarsening(dset, 'euratl') == factor
+
+    coarse = utils.coarsen_dataset(dset, 'euratl', 'gph_500_mslp')
+    assert coarse['prmsl'].shape == (2, -(-dset['lat'].size // factor),
+                                     -(-dset['lon'].size // factor))
+    assert coarse['prmsl'].attrs['coarsening'] == factor
+    assert coarse['run'].values == dset['run'].values
+    # Mean of every complete block
+    rows, columns = (dset['lat'].size // factor) * factor, (dset['lon'].size // factor) * factor
+    blocks = dset['prmsl'].values[:, :rows, :columns].reshape(
+        2, rows // factor, factor, columns // factor, factor).mean(axis=(2, 4))
+    np.testing.assert_allclose(coarse['prmsl'].values[:, :rows // factor, :columns // factor],
+                               blocks)
+    # The products at full resolution are not averaged
+    assert utils.coarsen_dataset(dset, 'euratl', 'pv_250') is dset
+
+    sizes = []
+    monkeypatch.setattr(hilo, 'labels', lambda ax, lon, lat, data, extrema, nsize, symbol,
+                        color: sizes.append(nsize))
+    data = coarse['prmsl'].isel(time=0)
+    utils.plot_maxmin_points(None, data['lon'], data['lat'], data, 'max', 60, symbol='H')
+    assert sizes == [60 // factor]
@@ -0,0 +1,69 @@
+import os
+import sys
+import matplotlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+matplotlib.use('Agg')
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import matplotlib.pyplot as plt  # noqa: E402
+import utils  # noqa: E402
+import isolines  # noqa: E402
+
+"""
+The line contours of a product can be computed on the grid of one projection
+and reused by the projections whose grid is a cutout of it, which must find
+the same lines that ax.contour finds on their own grid.
+"""
+
+
+def get_field():
+    """A step of a 0.25 degrees grid over euratl, with some closed lines."""
+    lat = np.arange(29.5, 70.75, 0.25)
+    lon = np.arange(-23.5, 45.25, 0.25)
+    lon2d, lat2d = np.meshgrid(lon, lat)
+    field = 1000 + 20 * np.sin(lon2d / 7.) * np.cos(lat2d / 5.) + 0.1 * lat2d
+    dset = xr.Dataset({'prmsl': (('lat', 'lon'), field)},
+                      coords={'time': pd.Timestamp('2022-08-26 09:00'), 'lat': lat, 'lon': lon})
+
+    return dset['prmsl']
+
+
+def get_vertices(c):
+    """All the vertices of the lines of a ContourSet, rounded and sorted."""
+    vertices = [line for segs in c.allsegs for line in segs if len(line)]
+
+    return np.unique(np.concatenate(vertices).round(6), axis=0)
+
+
+def test_shared_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'cache_folder', str(tmp_path) + '/')
+    monkeypatch.setattr(utils, 'isolines_products', {'gph_500_mslp': ['euratl', 'it']})
+    run = np.datetime64('2022-08-26T06:00')
+    levels = np.arange(985., 1020., 4.)
+    parent = get_field()
+    child = parent.sel(lat=slice(36, 47.5), lon=slice(6, 19))
+    ax = plt.figure().add_subplot()
+
+    # The lines of it are not saved yet
+    x, y = np.meshgrid(child['lon'], child['lat'])
+    assert not os.path.exists(isolines.get_filename(child, 'gph_500_mslp', run))
+    isolines.contour(ax, x, y, parent, 'gph_500_mslp', 'euratl', run,
+                     levels=levels, colors='k')
+    assert os.path.exists(isolines.get_filename(child, 'gph_500_mslp', run))
+
+    # Any projected grid works, the lines are interpolated on it
+    x, y = 2 * x + 1, y - 3
+    shared = isolines.contour(ax, x, y, child, 'gph_500_mslp', 'it', run,
+                              levels=levels, colors='k')
+    own = ax.contour(x, y, child, levels=levels, colors='k')
+    assert type(shared) is not type(own)
+    np.testing.assert_allclose(get_vertices(shared), get_vertices(own), atol=1e-6)
+
+    # Not shared for the projections that are not listed
+    other = isolines.contour(ax, x, y, child, 'gph_500_mslp', 'de', run,
+                             levels=levels, colors='k')
+    assert type(other) is type(own)
+    plt.close('all')
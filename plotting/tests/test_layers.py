@@ -0,0 +1,65 @@
+import os
+import sys
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.image as mpimg
+from matplotlib.offsetbox import AnchoredText
+import numpy as np
+
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils  # noqa: E402
+import layers  # noqa: E402
+
+"""
+The frames composited over the static layers have to look like the same
+frames saved with figure.savefig, also when static artists are between
+the artists of the frame (e.g. the coastlines between the data and the
+annotations).
+"""
+
+
+def draw_static(ax):
+    x = np.linspace(0, 1, 50)
+    ax.fill_between(x, 0, 1, color='lightgray', zorder=0)
+    ax.plot(x, 0.5 + 0.4 * np.sin(6 * x), color='black', linewidth=2, zorder=7)
+    ax.plot(x, 1 - x, color='blue', linewidth=1, zorder=7)
+    # Through the H and the annotation of the frames
+    ax.plot(x, np.full_like(x, 0.52), color='red', linewidth=4, zorder=7)
+    ax.plot(x, np.full_like(x, 0.97), color='red', linewidth=4, zorder=7)
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+
+
+def draw_frame(ax, step):
+    x, y = np.meshgrid(np.linspace(0, 1, 30), np.linspace(0, 1, 30))
+    cs = ax.contourf(x, y, np.sin(4 * x + step) * y, levels=10, cmap='viridis', alpha=0.8)
+    text = ax.text(0.4, 0.5, 'H', fontsize=40, zorder=8)
+    at = AnchoredText('Run %d' % step, prop=dict(size=12), frameon=True, loc='upper left')
+    at.zorder = 10
+    ax.add_artist(at)
+
+    return [cs, text, at]
+
+
+def test_savefig(tmp_path, monkeypatch):
+    monkeypatch.setattr(layers, 'memoised', layers.OrderedDict())
+    monkeypatch.setattr(utils, 'composite_layers', True)
+    ax = utils.create_figure().add_subplot()
+    draw_static(ax)
+    ax.figure.colorbar(ax.contourf(np.random.rand(3, 3), alpha=0), ax=ax)
+    for step in range(3):
+        artists = draw_frame(ax, step)
+        layers.savefig(str(tmp_path / 'frame.png'), artists, key='test')
+        # The layers are cropped at whole pixels, see layers.get_box
+        ax.figure.savefig(tmp_path / 'expected.png',
+                          **dict(utils.options_savefig, bbox_inches=None))
+        utils.remove_collections(artists)
+
+        frame = mpimg.imread(tmp_path / 'frame.png')
+        box = layers.get_box(ax.figure, utils.options_savefig['dpi'])
+        expected = mpimg.imread(tmp_path / 'expected.png')[box]
+        assert frame.shape == expected.shape
+        difference = np.abs(frame - expected)
+        # Only rounding, as the layers are blended separately
+        assert difference.max() < 0.05
@@ -0,0 +1,44 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+os.environ.setdefault('MAPBOX_KEY', '')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scheduler  # noqa: E402
+import shared  # noqa: E402
+
+"""
+The time steps are plotted in batches of consecutive steps, so that the
+workers plot them from the shared memory without copying them.
+"""
+
+
+def test_batches():
+    costs = np.r_[np.full(40, 2.), np.full(40, 1.)]
+    batches = scheduler.get_batches(costs, 4, max_size=10)
+    assert all(isinstance(batch, slice) for batch in batches)
+    # Every step is in one batch
+    steps = np.concatenate([np.arange(costs.size)[batch] for batch in batches])
+    np.testing.assert_array_equal(np.sort(steps), np.arange(costs.size))
+    assert max(batch.stop - batch.start for batch in batches) <= 10
+    # The most expensive batches first, the last ones are smaller
+    totals = [costs[batch].sum() for batch in batches]
+    assert totals == sorted(totals, reverse=True)
+    assert totals[-1] < totals[0]
+
+
+def test_shared_batch():
+    time = pd.date_range('2022-08-26 09:00', periods=6, freq='3h')
+    dset = xr.Dataset({'prmsl': (('time', 'lat', 'lon'), np.random.rand(6, 3, 4))},
+                      coords={'time': time, 'lat': np.arange(3.), 'lon': np.arange(4.)})
+    handle = shared.share(dset, {'x': np.zeros((3, 4)), 'projection': 'euratl'})
+    try:
+        dss, args = shared.get(handle, slice(2, 5))
+        np.testing.assert_array_equal(dss['prmsl'].values, dset['prmsl'].values[2:5])
+        assert args['projection'] == 'euratl'
+        assert np.shares_memory(dss['prmsl'].values, handle.arrays[0].get())
+    finally:
+        dss = args = None
+        handle.release()
@@ -16,7 +16,13 @@ import re
 from matplotlib.image import imread as read_png
 import requests
 import json
+import pickle
+import hashlib
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import hilo
+import sprites
 
 
 import warnings
@@ -34,6 +40,14 @@ else:
     folder = '/home/ekman/ssd/guido/gfs/'
 
 folder_images = folder
+# Objects that do not change from run to run (e.g. projections) are cached here
+if 'CACHE_FOLDER' in os.environ:
+    cache_folder = os.environ['CACHE_FOLDER']
+else:
+    cache_folder = folder + 'cache/'
+# Cutouts of the run for every projection (see write_cutouts.py)
+cutouts_folder = folder + 'cutouts/'
+# Maximum number of time steps plotted by a worker in a single task (see scheduler.py)
 chunks_size = 10
 processes = 9
 figsize_x = 10
@@ -52,6 +66,25 @@ options_savefig = {
     'bbox_inches': 'tight',
     'transparent': False
 }
+# Render the static layers of the maps only once for every product and
+# projection and composite them with the data of every frame (see layers.py)
+composite_layers = True
+# Products (variable_name) whose filled contours are drawn as images instead
+# of contourf, for every projection listed (see raster.py)
+raster_products = {
+    'precip_acc': ['euratl', 'it', 'de', 'nh_polar'],
+}
+# The fields are averaged in blocks of grid points before being plotted when
+# the grid has more than this many points per pixel of the images (see
+# coarsen_dataset), except for the products (variable_name) listed here
+points_per_pixel = 1
+full_resolution_products = ['pv_250']
+# Sizes of the blocks already known, by name of their file in the cache
+coarsenings = {}
+# The line contours of these products (variable_name) are computed only for
+# the first projection listed, whose grid contains the others, and reused by
+# the others (see isolines.py)
+isolines_products = {}
 
 # Dictionary to map the output folder based on the projection employed
 subfolder_images = {
@@ -173,6 +206,13 @@ proj_defs = {
 }
 
 
+# Administrative boundaries drawn on top of the regional projections
+shapefiles = {
+    'it': home_folder + '/plotting/shapefiles/ITA_adm/ITA_adm1',
+    'de': home_folder + '/plotting/shapefiles/DEU_adm/DEU_adm1',
+}
+
+
 def get_weather_icons(ww, time):
     """
     Get the path to a png given the weather representation 
@@ -202,27 +242,96 @@ def get_weather_icons(ww, time):
     return (weather_icons)
 
 
-def read_dataset(variables=['2t', '2d'], level=None, projection=None,
-                 engine='scipy'):
-    """Wrapper to initialize the dataset"""
-    files = glob(folder+'gfs*.nc')
-    run = pd.to_datetime(re.findall(r'(?:\d{10})', files[0])[0],
-                         format='%Y%m%d%H')
-    # find only the files with the variables that we need
-    dset = xr.open_dataset(files[0],
-                           engine=engine,
-                           ).sortby(["time", "lon", "lat"])
+def get_run(filename):
+    """Get the run from the name of a file, e.g. gfs_2022082606.nc
+    or grib_gfs_20220826_06_f003.nc"""
+    date, hour = re.findall(r'(\d{8})_?(\d{2})', os.path.basename(filename.rstrip('/')))[0]
+
+    return pd.to_datetime(date + hour, format='%Y%m%d%H')
+
+
+def open_dataset(filename=None, engine='scipy', projection=None):
+    """Open the whole dataset without any subsetting, so that it can be
+    shared by many products and projections (see read_dataset).
+    If no filename is given the cutout of the projection is used, if it
+    was written (see write_cutouts.py), otherwise the Zarr store of the run
+    (see to_zarr.py) or, if missing, the merged NetCDF file. Nothing is read
+    here: the dataset is only a view which is read when (and where) it is needed."""
+    if not filename:
+        filename = get_cutout(projection) or \
+            (glob(folder+'gfs*.zarr') + glob(folder+'gfs*.nc'))[0]
+    if filename.rstrip('/').endswith('.zarr'):
+        dset = xr.open_zarr(filename)
+    else:
+        dset = xr.open_dataset(filename,
+                               engine=engine,
+                               )
+    dset = orient(dset)
     dset = dset.metpy.parse_cf()
-    if level:
-        dset = dset.sel(plev=level, method='nearest').squeeze()
+    dset['run'] = get_run(filename)
+
+    return dset
+
+
+def get_cutout(projection):
+    """Cutout of the projection, None if it was not written."""
+    if not projection:
+        return None
+    cutouts = glob(cutouts_folder + 'gfs_*_%s.zarr' % projection)
+
+    return cutouts[0] if cutouts else None
+
+
+def orient(dset, dims=["time", "lon", "lat"]):
+    """Make the coordinates increasing, as sortby would do, but reversing the
+    dimensions that are decreasing (e.g. latitude in GRIB files) instead of
+    sorting them, so that the data is not read."""
+    for dim in dims:
+        if dim not in dset.dims:
+            continue
+        index = dset.indexes[dim]
+        if index.is_monotonic_increasing:
+            continue
+        if index.is_monotonic_decreasing:
+            dset = dset.isel({dim: slice(None, None, -1)})
+        else:
+            dset = dset.sortby(dim)
+
+    return dset
+
+
+def get_box_slices(dset, projection):
+    """Index slices of the box of projection, computed from the (increasing)
+    coordinates, so that only this hyperslab is read."""
+    proj_options = proj_defs[projection]
+    slices = {}
+    for dim, begin, end in [('lat', proj_options['llcrnrlat'], proj_options['urcrnrlat']),
+                            ('lon', proj_options['llcrnrlon'], proj_options['urcrnrlon'])]:
+        values = dset[dim].values
+        slices[dim] = slice(np.searchsorted(values, begin, side='left'),
+                            np.searchsorted(values, end, side='right'))
+
+    return slices
+
+
+def read_dataset(variables=['2t', '2d'], level=None, projection=None,
+                 engine='scipy', dset=None):
+    """Wrapper to initialize the dataset. If dset is given (see open_dataset)
+    the subset is taken from it instead of opening the file again.
+    Variables, box and levels are selected before anything is read, so
+    only these are read from disk and only when needed."""
+    if dset is None:
+        dset = open_dataset(engine=engine, projection=projection)
+    run = dset['run']
     if variables:
         dset = dset[variables]
     if projection:
-        proj_options = proj_defs[projection]
-        dset = dset.sel(lat=slice(proj_options['llcrnrlat'],
-                                  proj_options['urcrnrlat']),
-                        lon=slice(proj_options['llcrnrlon'],
-                                  proj_options['urcrnrlon']))
+        dset = dset.isel(get_box_slices(dset, projection))
+    if level:
+        dset = dset.sel(plev=level, method='nearest')
+        # Only drop the vertical dimension, a single time step has to be kept
+        if dset['plev'].size == 1:
+            dset = dset.squeeze('plev')
 
     dset['run'] = run
 
@@ -231,6 +340,69 @@ def read_dataset(variables=['2t', '2d'], level=None, projection=None,
     return dset
 
 
+def get_coarsening(dset, projection):
+    """Size of the blocks of grid points (see compute_coarsening), computed
+    only once for every projection and grid and then read from the cache."""
+    lat, lon = dset['lat'].values, dset['lon'].values
+    filename = get_cache_filename(projection, lat.size, lon.size,
+                                  float(lat.min()), float(lat.max()),
+                                  float(lon.min()), float(lon.max()),
+                                  points_per_pixel, figsize_x, figsize_y,
+                                  options_savefig['dpi'], suffix='_coarsening.pkl')
+    if filename not in coarsenings:
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                coarsenings[filename] = pickle.load(f)
+        else:
+            coarsenings[filename] = compute_coarsening(dset, projection)
+            write_cache(filename, coarsenings[filename])
+
+    return coarsenings[filename]
+
+
+def compute_coarsening(dset, projection):
+    """Size of the blocks of grid points (the same in both directions) with
+    about points_per_pixel points per pixel of the images, from the median
+    spacing of the projected grid in the map."""
+    m = get_basemap(projection)
+    lon2d, lat2d = get_coordinates(dset)
+    x, y = get_projected_coordinates(m, projection, lon2d, lat2d)
+    # Size of a pixel in the units of the projection, the map is as large
+    # as the figure in one of the two directions
+    pixel = max((m.xmax - m.xmin) / (figsize_x * options_savefig['dpi']),
+                (m.ymax - m.ymin) / (figsize_y * options_savefig['dpi']))
+    inside = (x >= m.xmin) & (x <= m.xmax) & (y >= m.ymin) & (y <= m.ymax)
+    factors = []
+    for axis in (0, 1):
+        spacing = np.hypot(np.diff(x, axis=axis), np.diff(y, axis=axis))
+        spacing = spacing[inside[1:, :] if axis == 0 else inside[:, 1:]]
+        if spacing.size == 0:
+            return 1
+        factors.append(int(pixel / (np.median(spacing) * points_per_pixel)))
+
+    return max(min(factors), 1)
+
+
+def coarsen_dataset(dset, projection, product):
+    """Average the fields in blocks of grid points so that the grid is about
+    as fine as the pixels of the images (see get_coarsening), which is all
+    that contour/contourf can show. The size of the blocks is saved in the
+    attribute coarsening of every variable (see plot_maxmin_points)."""
+    if product in full_resolution_products:
+        return dset
+    factor = get_coarsening(dset, projection)
+    if factor == 1:
+        return dset
+    print_message('Averaging the fields of %s in blocks of %d grid points' % (product, factor))
+    run = dset['run']
+    dset = dset.drop_vars('run').coarsen(lat=factor, lon=factor, boundary='pad').mean()
+    for var in dset.data_vars:
+        dset[var].attrs['coarsening'] = factor
+    dset['run'] = run
+
+    return dset
+
+
 def get_time_run_cum(dset):
     time = dset['time'].to_pandas()
     run = dset['run'].to_pandas()
@@ -298,11 +470,34 @@ def get_city_coordinates(city):
         return lon, lat
 
 
-def get_projection(dset, projection="euratl", countries=True, labels=True, color_borders='black'):
+def create_figure(pyplot=False):
+    """Figure with its own Agg canvas which is not managed by pyplot, so
+    that many figures can be drawn at the same time by different threads
+    (see render_all.py). Only to show it (debug) the figure is created
+    with pyplot."""
+    if pyplot:
+        import matplotlib.pyplot as plt
+        return plt.figure(figsize=(figsize_x, figsize_y))
+    figure = Figure(figsize=(figsize_x, figsize_y))
+    FigureCanvasAgg(figure)
+
+    return figure
+
+
+def show():
+    """Show the figures created with create_figure(pyplot=True)."""
+    import matplotlib.pyplot as plt
+    plt.show(block=True)
+
+
+def get_projection(dset, projection="euratl", countries=True, labels=True, color_borders='black',
+                   ax=None):
+    """Basemap of the projection drawn on ax (if not given the current
+    axes of pyplot), with the grid of dset projected on it."""
     lon2d, lat2d = get_coordinates(dset)
-    from mpl_toolkits.basemap import Basemap  # import Basemap matplotlib toolkit
-    proj_options = proj_defs[projection]
-    m = Basemap(**proj_options)
+    m = get_basemap(projection)
+    # Everything is drawn on ax, pyplot is not used
+    m.ax = ax
     if projection == "euratl":
         if labels:
             m.drawparallels(np.arange(-90.0, 90.0, 10.), linewidth=0.2, color='white',
@@ -311,16 +506,14 @@ def get_projection(dset, projection="euratl", countries=True, labels=True, color
                             labels=[True, False, False, True], fontsize=7)
 
     elif projection == "it":
-        m.readshapefile(home_folder + '/plotting/shapefiles/ITA_adm/ITA_adm1',
-                        'ITA_adm1', linewidth=0.2, color='black', zorder=7)
+        draw_shapes(m, linewidth=0.2, color='black', zorder=7)
         if labels:
             m.drawparallels(np.arange(-90.0, 90.0, 5.), linewidth=0.2, color='white',
                             labels=[True, False, False, True], fontsize=7)
             m.drawmeridians(np.arange(0.0, 360.0, 5.), linewidth=0.2, color='white',
                             labels=[True, False, False, True], fontsize=7)
     elif projection == "de":
-        m.readshapefile(home_folder + '/plotting/shapefiles/DEU_adm/DEU_adm1',
-                        'DEU_adm1', linewidth=0.2, color='black', zorder=7)
+        draw_shapes(m, linewidth=0.2, color='black', zorder=7)
         if labels:
             m.drawparallels(np.arange(-90.0, 90.0, 5.), linewidth=0.2, color='white',
                             labels=[True, False, False, True], fontsize=7)
@@ -333,11 +526,99 @@ def get_projection(dset, projection="euratl", countries=True, labels=True, color
         m.drawcountries(linewidth=0.5, linestyle='solid',
                         color=color_borders, zorder=7)
 
-    x, y = m(lon2d, lat2d)
+    x, y = get_projected_coordinates(m, projection, lon2d, lat2d)
 
     return (m, x, y)
 
 
+def get_cache_filename(projection, *args, suffix='.pkl'):
+    """Name of a file in the cache for a projection. The definition of the
+    projection in proj_defs and args (e.g. the grid) are hashed in the name,
+    so that a cached object is never used after they change."""
+    definition = json.dumps(proj_defs[projection], sort_keys=True) + repr(args)
+    key = hashlib.md5(definition.encode()).hexdigest()[:12]
+
+    return cache_folder + '%s_%s%s' % (projection, key, suffix)
+
+
+def write_cache(filename, obj):
+    """Write an object (numpy arrays as .npy) to the cache. The file is renamed
+    only when complete so that concurrent readers never see a partial file."""
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_filename = filename + '.%d.tmp' % os.getpid()
+    with open(tmp_filename, 'wb') as f:
+        if isinstance(obj, np.ndarray):
+            np.save(f, obj)
+        else:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_filename, filename)
+
+
+def get_basemap(projection):
+    """Create the Basemap instance for a projection, together with the shapes
+    of the administrative boundaries, or read it from the cache."""
+    filename = get_cache_filename(projection)
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    from mpl_toolkits.basemap import Basemap  # import Basemap matplotlib toolkit
+    m = Basemap(**proj_defs[projection])
+    if projection in shapefiles:
+        # Only read and project the shapes here, they're drawn by draw_shapes
+        m.readshapefile(shapefiles[projection], 'shapes', drawbounds=False)
+    write_cache(filename, m)
+
+    return m
+
+
+def draw_shapes(m, linewidth=0.2, color='black', zorder=7, ax=None):
+    """Draw the boundaries read by get_basemap, same as readshapefile
+    with drawbounds=True but without reading the shapefile again."""
+    from matplotlib.collections import LineCollection
+    ax = ax or m._check_ax()
+    lines = LineCollection(m.shapes, antialiaseds=(1,))
+    lines.set_color(color)
+    lines.set_linewidth(linewidth)
+    lines.set_label('_nolabel_')
+    lines.set_zorder(zorder)
+    ax.add_collection(lines)
+    m.set_axes_limits(ax=ax)
+
+    return lines
+
+
+def get_projected_coordinates(m, projection, lon2d, lat2d):
+    """Project the lon/lat grid on the map, or read the result from the cache
+    if the same grid was already projected."""
+    filename = get_cache_filename(projection, lon2d.shape,
+                                  float(lon2d.min()), float(lon2d.max()),
+                                  float(lat2d.min()), float(lat2d.max()),
+                                  suffix='_xy.npy')
+    if os.path.isfile(filename):
+        x, y = np.load(filename)
+        return x, y
+
+    x, y = m(lon2d, lat2d)
+    write_cache(filename, np.stack([x, y]))
+
+    return x, y
+
+
+def draw_relief(m, projection, service='World_Shaded_Relief', xpixels=1500):
+    """Same as m.arcgisimage but the image is only downloaded the first
+    time and then read from the cache."""
+    filename = get_cache_filename(projection, service, xpixels,
+                                  suffix='_relief.npy')
+    if os.path.isfile(filename):
+        return m.imshow(np.load(filename), origin='upper')
+
+    image = m.arcgisimage(service=service, xpixels=xpixels)
+    write_cache(filename, np.asarray(image.get_array()))
+
+    return image
+
+
 # def get_projection_cartopy(plt, projection="euratl"):
 #     '''Retrieve the projection using cartopy'''
 #     print('projection = %s' % projection)
@@ -511,52 +792,28 @@ def remove_collections(elements):
             print_message('WARNING: Collection is empty')
 
 
-def plot_maxmin_points(ax, lon, lat, data, extrema, nsize, symbol, color='k',
-                       random=False):
+def plot_maxmin_points(ax, lon, lat, data, extrema, nsize, symbol, color='k'):
     """
     This function will find and plot relative maximum and minimum for a 2D grid. The function
     can be used to plot an H for maximum values (e.g., High pressure) and an L for minimum
     values (e.g., low pressue). It is best to used filetered data to obtain  a synoptic scale
     max/min value. The symbol text can be set to a string value and optionally the color of the
-    symbol and any plotted value can be set with the parameter color
+    symbol and the numeric value is plotted below it in gray
     lon = plotting longitude values (2D)
     lat = plotting latitude values (2D)
     data = 2D data that you wish to plot the max/min symbol placement
     extrema = Either a value of max for Maximum Values or min for Minimum Values
     nsize = Size of the grid box to filter the max and min values to plot a reasonable number
     symbol = String to be placed at location of max/min value
-    color = String matplotlib colorname to plot the symbol (and numerica value, if plotted)
-    plot_value = Boolean (True/False) of whether to plot the numeric value of max/min point
+    color = String matplotlib colorname to plot the symbol
     The max/min symbol will be plotted on the current axes within the bounding frame
-    (e.g., clip_on=True)
+    (e.g., clip_on=True). Only one point is kept among the ones with the same value
+    in a box, so the result is always the same (see hilo.py).
     """
-    from scipy.ndimage.filters import maximum_filter, minimum_filter
-
-    # We have to first add some random noise to the field, otherwise it will find many maxima
-    # close to each other. This is not the best solution, though...
-    if random:
-        data = np.random.normal(data, 0.2)
-
-    if (extrema == 'max'):
-        data_ext = maximum_filter(data, nsize, mode='nearest')
-    elif (extrema == 'min'):
-        data_ext = minimum_filter(data, nsize, mode='nearest')
-    else:
-        raise ValueError('Value for hilo must be either max or min')
-
-    mxy, mxx = np.where(data_ext == data)
-    # Filter out points on the border
-    mxx, mxy = mxx[(mxy != 0) & (mxx != 0)], mxy[(mxy != 0) & (mxx != 0)]
+    # nsize is in points of the grid before averaging (see coarsen_dataset)
+    nsize = max(nsize // getattr(data, 'attrs', {}).get('coarsening', 1), 1)
 
-    texts = []
-    for i in range(len(mxy)):
-        texts.append(ax.text(lon[mxy[i], mxx[i]], lat[mxy[i], mxx[i]], symbol, color=color, size=15,
-                             clip_on=True, horizontalalignment='center', verticalalignment='center',
-                             path_effects=[path_effects.withStroke(linewidth=1, foreground="black")], zorder=8))
-        texts.append(ax.text(lon[mxy[i], mxx[i]], lat[mxy[i], mxx[i]], '\n' + str(data[mxy[i], mxx[i]].astype('int')),
-                             color="gray", size=10, clip_on=True, fontweight='bold',
-                             horizontalalignment='center', verticalalignment='top', zorder=8))
-    return (texts)
+    return hilo.labels(ax, lon, lat, data, extrema, nsize, symbol, color=color)
 
 
 def add_vals_on_map(ax, projection, var, levels, density=50,
@@ -579,21 +836,21 @@ def add_vals_on_map(ax, projection, var, levels, density=50,
                   lon=slice(lon_min + 0.15, lon_max - 0.15))[::density, ::density]
     # var.where((ds.lon <= 150) & (ds.lon >= 60)
     #                  & (ds.lat <= 75) & (ds.lat >= 30), drop=True)
-    lons = var.lon
-    lats = var.lat
-
-    at = []
-    for ilat, ilon in np.ndindex(var.shape):
-        if lcolors:
-            at.append(ax.annotate(('%d' % var[ilat, ilon]), (lons[ilon] + shift_x, lats[ilat] + shift_y),
-                                  color=m.to_rgba(float(var[ilat, ilon])), weight='bold', fontsize=fontsize,
-                                  path_effects=[path_effects.withStroke(linewidth=1, foreground="black")], zorder=5))
-        else:
-            at.append(ax.annotate(('%d' % var[ilat, ilon]), (lons[ilon] + shift_x, lats[ilat] + shift_y),
-                                  color='white', weight='bold', fontsize=fontsize,
-                                  path_effects=[path_effects.withStroke(linewidth=1, foreground="black")], zorder=5))
+    lons, lats = np.meshgrid(var.lon.values + shift_x, var.lat.values + shift_y)
+    values = np.asarray(var.values, dtype=np.float64)
+    valid = np.isfinite(values)
+    values = values[valid]
+    texts = values.astype(int).astype(str)
+    # All the values are drawn by a single artist, see sprites.py
+    if lcolors:
+        color = m.to_rgba(values)
+    else:
+        color = 'white'
+    at = sprites.Labels(ax, lons[valid], lats[valid], texts, color=color, size=fontsize,
+                        weight='bold', ha='left', va='baseline', stroke='black', zorder=5)
+    ax.add_artist(at)
 
-    return at
+    return [at]
 
 
 def divide_axis_for_cbar(ax, width="45%", height="2%", pad=-3, adjust=0.05):
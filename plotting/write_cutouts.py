@@ -0,0 +1,89 @@
+import pandas as pd
+import argparse
+import importlib
+import shutil
+import utils
+import time
+import os
+
+import warnings
+warnings.filterwarnings(
+    action='ignore',
+    message='Consolidated metadata is currently not part'
+)
+
+"""
+Write, once per run, a cutout of the dataset for every projection with
+only its box and the variables and levels needed by the products
+(their read_options), in float32 and with one chunk per forecast step.
+utils.read_dataset then reads the (much smaller) cutout of the projection
+instead of the global dataset, so that the many readers of the small
+domains do not all compete for the same file.
+"""
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-s', '--products', help='Products (plotting scripts) that read the cutouts',
+                    default=["plot_gph_500_mslp", "plot_gph_t_50", "plot_gph_t_10",
+                             "plot_gph_t_850", "plot_rain_acc", "plot_pv_250",
+                             "plot_rain_clouds", "plot_hsnow"],
+                    nargs='+')
+parser.add_argument('-p', '--projections', help='Projections',
+                    default=["euratl", "it", "de", "nh_polar"],
+                    choices=list(utils.proj_defs.keys()),
+                    nargs='+')
+
+
+def main():
+    args = parser.parse_args()
+    dset = utils.open_dataset()
+    read_options = [importlib.import_module(product.replace('.py', '')).read_options
+                    for product in args.products]
+    variables = sorted({var for options in read_options for var in options['variables']})
+    levels = sorted({level for options in read_options for level in options.get('level') or []})
+    # If a product reads a variable on levels without selecting them, all are needed
+    for options in read_options:
+        if not options.get('level') and \
+                any('plev' in dset[var].dims for var in options['variables']):
+            levels = None
+
+    for projection in args.projections:
+        filename = write_cutout(dset, projection, variables, levels)
+        utils.print_message('Written %s' % filename)
+
+
+def write_cutout(dset, projection, variables, levels=None):
+    run = pd.to_datetime(dset['run'].values)
+    dset = dset[variables]
+    dset = dset.isel(utils.get_box_slices(dset, projection))
+    if levels and ('plev' in dset.dims):
+        dset = dset.sel(plev=levels)
+    if 'metpy_crs' in dset.coords:
+        dset = dset.drop_vars('metpy_crs')
+    for var in dset.data_vars:
+        dset[var] = dset[var].astype('float32')
+    # The encoding of the original file (e.g. chunks) does not apply here
+    for var in dset.variables.values():
+        var.encoding = {key: value for key, value in var.encoding.items()
+                        if key in ['units', 'calendar', '_FillValue']}
+    dset = dset.chunk({dim: 1 if dim == 'time' else -1 for dim in dset.dims})
+
+    os.makedirs(utils.cutouts_folder, exist_ok=True)
+    filename = utils.cutouts_folder + 'gfs_%s_%s.zarr' % (run.strftime('%Y%m%d%H'), projection)
+    # Written with another name first so that an incomplete cutout is never used
+    if os.path.exists(filename + '.tmp'):
+        shutil.rmtree(filename + '.tmp')
+    dset.to_zarr(filename + '.tmp', mode='w', consolidated=True)
+    if os.path.exists(filename):
+        shutil.rmtree(filename)
+    os.replace(filename + '.tmp', filename)
+
+    return filename
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
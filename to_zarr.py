@@ -0,0 +1,54 @@
+import xarray as xr
+import argparse
+import shutil
+import os
+
+import warnings
+warnings.filterwarnings(
+    action='ignore',
+    message='Consolidated metadata is currently not part'
+)
+
+"""
+Convert the NetCDF file produced by cdo into a compressed Zarr store.
+Every chunk of the store contains a single forecast step of a single
+variable (and level) over a region, so that every plot reads only the
+variables, levels and regions it needs, and only when it needs them.
+"""
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('input', help='NetCDF file (e.g. gfs_2022082606.nc)')
+parser.add_argument('-o', '--output', help='Zarr store (default same name as input with .zarr)')
+parser.add_argument('--lat', help='Points in latitude of every chunk', default=160, type=int)
+parser.add_argument('--lon', help='Points in longitude of every chunk', default=160, type=int)
+
+
+def main():
+    args = parser.parse_args()
+    output = args.output or os.path.splitext(args.input)[0] + '.zarr'
+
+    dset = xr.open_dataset(args.input, engine='scipy', chunks={})
+    # Stored in the same order used by the plotting
+    dset = dset.sortby(["time", "lon", "lat"])
+    chunks = {'time': 1, 'lat': args.lat, 'lon': args.lon}
+    chunks = {dim: size for dim, size in chunks.items() if dim in dset.dims}
+    for dim in dset.dims:
+        chunks.setdefault(dim, 1)
+    dset = dset.chunk(chunks)
+    # The encoding of the NetCDF3 file (e.g. chunks) does not apply to Zarr
+    for var in dset.variables.values():
+        var.encoding = {key: value for key, value in var.encoding.items()
+                        if key in ['units', 'calendar', 'dtype', '_FillValue']}
+
+    # Written with another name first so that an incomplete store is never used
+    if os.path.exists(output + '.tmp'):
+        shutil.rmtree(output + '.tmp')
+    dset.to_zarr(output + '.tmp', mode='w', consolidated=True)
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.replace(output + '.tmp', output)
+
+
+if __name__ == "__main__":
+    main()